@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+import nats.js
+from nats.js.api import ConsumerInfo
+from prometheus_client import Counter, Gauge, Histogram
+
+fetch_batch_size = Gauge("nats_fetch_batch_size", "max messages per fetch", ["consumer"])
+fetch_flush_interval = Gauge("nats_fetch_flush_interval_seconds", "wait after a partial fetch", ["consumer"])
+consumer_pending = Gauge("nats_consumer_pending", "messages not delivered yet", ["consumer"])
+consumer_ack_pending = Gauge("nats_consumer_ack_pending", "messages delivered and not acked yet", ["consumer"])
+fetch_wait = Histogram("nats_fetch_wait_seconds", "time spent waiting on a fetch", ["consumer"])
+write_latency = Gauge("nats_consumer_write_latency_seconds", "moving average of a batch write", ["consumer", "target"])
+fetch_decisions = Counter("nats_fetch_decisions", "batch size decisions", ["consumer", "decision"])
+
+
+def record_consumer_info(info: ConsumerInfo):
+    consumer_pending.labels(info.name).set(info.num_pending)
+    consumer_ack_pending.labels(info.name).set(info.num_ack_pending)
+
+
+async def watch_consumer(js: nats.js.JetStreamContext, stream: str, consumer: str, stop_event: asyncio.Event):
+    """Exports the consumer lag every 5 seconds, for consumers without an `AdaptiveFetchPolicy`."""
+    while not stop_event.is_set():
+        try:
+            record_consumer_info(await js.consumer_info(stream, consumer))
+        except Exception as e:
+            print(f"Error reading consumer {consumer} info: {e}")
+        await asyncio.sleep(5)
+
+
+class FetchPolicy:
+    """How NATSManager consumers fetch.
+
+    Up to `batch_size` messages are fetched at once. Whenever a fetch comes back partial, the next one waits
+    `flush_interval` seconds, so a caught up consumer does not write a handful of messages at a time.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float = 0.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+
+class AdaptiveFetchPolicy(FetchPolicy):
+    """Fetch policy steered by the consumer lag and by how long the batches take to be written.
+
+    Every `period` seconds: a batch size is grown while the consumer is more than a batch behind and the slowest
+    write target stays under `target_latency`, shrunk while a target is over it, and drifts down to `min_batch`
+    once caught up. When caught up, partial fetches are spaced by twice the write latency, within the interval
+    bounds; when behind, the next batch is fetched right away.
+    """
+
+    def __init__(
+        self,
+        js: nats.js.JetStreamContext,
+        stream: str,
+        consumer: str,
+        batch_size: int,
+        min_batch: int,
+        max_batch: int,
+        min_interval: float,
+        max_interval: float,
+        target_latency: float,
+        period: float = 5.0,
+    ):
+        super().__init__(batch_size, min_interval)
+        self.js = js
+        self.stream = stream
+        self.consumer = consumer
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_latency = target_latency
+        self.period = period
+        self._latency: dict[str, tuple[float, float]] = {}
+        fetch_batch_size.labels(consumer).set_function(lambda: self.batch_size)
+        fetch_flush_interval.labels(consumer).set_function(lambda: self.flush_interval)
+
+    def observe_write(self, target: str, seconds: float):
+        previous = self._latency.get(target)
+        latency = seconds if previous is None else 0.7 * previous[0] + 0.3 * seconds
+        self._latency[target] = (latency, time.monotonic())
+        write_latency.labels(self.consumer, target).set(latency)
+
+    async def run(self, stop_event: asyncio.Event):
+        while not stop_event.is_set():
+            await asyncio.sleep(self.period)
+            try:
+                info = await self.js.consumer_info(self.stream, self.consumer)
+            except Exception as e:
+                print(f"Error reading consumer {self.consumer} info: {e}")
+                continue
+
+            record_consumer_info(info)
+            decision = self.decide(info.num_pending)
+            fetch_decisions.labels(self.consumer, decision).inc()
+
+    def decide(self, pending: int) -> str:
+        # targets that were not written for a while do not hold the batch size back
+        now = time.monotonic()
+        latency = max(
+            (latency for latency, updated_at in self._latency.values() if now - updated_at < 6 * self.period),
+            default=0.0,
+        )
+        behind = pending > self.batch_size
+
+        if latency > self.target_latency:
+            batch_size, decision = int(self.batch_size * 0.75), "shrink"
+        elif behind:
+            batch_size, decision = int(self.batch_size * 1.5), "grow"
+        else:
+            batch_size, decision = int(self.batch_size * 0.9), "settle"
+        self.batch_size = min(max(batch_size, self.min_batch), self.max_batch)
+
+        if behind:
+            self.flush_interval = self.min_interval
+        else:
+            self.flush_interval = min(max(2 * latency, self.min_interval), self.max_interval)
+        return decision
@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import time
+from typing import Any, Awaitable, Callable, NamedTuple
+
+
+class BufferPolicy(NamedTuple):
+    max_ops: int  # flushed once it holds this many ops
+    max_age: float  # or once its oldest op is this many seconds old
+    concurrency: int = 1  # bulk writes of the buffer running at once, above 1 writes may land out of order
+
+
+class _Batch:
+    __slots__ = ("failed", "msgs", "waiting")
+
+    def __init__(self, msgs: list):
+        self.msgs = msgs
+        self.waiting = 0  # buffer flushes holding ops of this batch
+        self.failed = False  # one of them was not written
+
+
+class WriteBuffer:
+    def __init__(
+        self,
+        target: str,
+        policy: BufferPolicy,
+        write: Callable[[str, list], Awaitable[None]],
+        on_written: Callable[[], None],
+    ):
+        self.target = target
+        self.policy = policy
+        self.write = write
+        self.on_written = on_written
+        self.ops = []
+        self.started: float | None = None
+        self._batches: list[_Batch] = []
+        self._slots = asyncio.Semaphore(max(policy.concurrency, 1))
+        self._tasks: set[asyncio.Task] = set()
+
+    def add(self, ops: list, batch: _Batch):
+        if not self.ops:
+            self.started = time.monotonic()
+        self.ops.extend(ops)
+        if not self._batches or self._batches[-1] is not batch:
+            batch.waiting += 1
+            self._batches.append(batch)
+
+        if len(self.ops) >= self.policy.max_ops:
+            self.flush()
+
+    def flush(self):
+        if not self.ops:
+            return
+        task = asyncio.create_task(self._write(self.ops, self._batches))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self.ops, self._batches, self.started = [], [], None
+
+    def holds(self, batch: _Batch) -> bool:
+        """Whether ops of `batch` are buffered and not flushed yet."""
+        return bool(self._batches) and self._batches[0] is batch
+
+    async def wait(self):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def _write(self, ops: list, batches: list[_Batch]):
+        # the semaphore hands out slots in order, so with a concurrency of 1 flushes are written in order
+        async with self._slots:
+            try:
+                await self.write(self.target, ops)
+            except Exception as e:
+                print(f"Error flushing {len(ops)} ops to {self.target}, their messages are not acked: {e}")
+                for batch in batches:
+                    batch.failed = True
+        for batch in batches:
+            batch.waiting -= 1
+        self.on_written()
+
+
+class BufferedWriter:
+    """Per-collection write buffers between the consumer and the database.
+
+    Every buffer is flushed on its own `BufferPolicy`. A batch of messages is acked, in fetch order, once every
+    buffer flush holding one of its ops is written. Once `max_batches` batches are not acked yet, the buffers
+    holding ops of the oldest one are flushed without waiting for their max age, and `add` waits for its ack.
+
+    A batch with a failed flush is never acked. With `nak` (messages acked one by one) its messages are nak'ed for
+    redelivery and the next batches are acked as usual. Otherwise acking a later message would ack it too: nothing
+    is acked anymore, `failed` is set and `add` drops what it is given, the consumer redelivers it all on restart.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[str, list], Awaitable[None]],
+        ack: Callable[[list[Any]], Awaitable[None]],
+        default_policy: BufferPolicy,
+        policies: dict[str, BufferPolicy] | None = None,
+        max_batches: int = 16,
+        nak: Callable[[list[Any]], Awaitable[None]] | None = None,
+    ):
+        self.write = write
+        self.ack = ack
+        self.nak = nak
+        self.failed = False
+        self.default_policy = default_policy
+        self.policies = policies or {}
+        self.max_batches = max_batches
+        self.buffers: dict[str, WriteBuffer] = {}
+        self._batches: collections.deque[_Batch] = collections.deque()
+        self._written = asyncio.Event()
+        self._ack_lock = asyncio.Lock()
+        self._acks: set[asyncio.Task] = set()
+
+    async def add(self, msgs: list, all_ops: dict[str, list]):
+        while len(self._batches) >= self.max_batches and not self.failed:
+            self._flush_holding(self._batches[0])
+            self._written.clear()
+            await self._written.wait()
+        if self.failed:
+            return
+
+        batch = _Batch(msgs)
+        self._batches.append(batch)
+        for target, ops in all_ops.items():
+            if ops:
+                self._buffer(target).add(ops, batch)
+        self._ack_written()
+
+    async def run(self, stop_event: asyncio.Event):
+        """Flushes the buffers whose oldest op is older than their max age."""
+        tick = min([self.default_policy.max_age, *(policy.max_age for policy in self.policies.values())]) / 2
+        while not stop_event.is_set():
+            await asyncio.sleep(tick)
+            now = time.monotonic()
+            for buffer in self.buffers.values():
+                if buffer.started is not None and now - buffer.started >= buffer.policy.max_age:
+                    buffer.flush()
+
+    async def close(self):
+        """Writes everything that is buffered and acks it."""
+        for buffer in self.buffers.values():
+            buffer.flush()
+        for buffer in self.buffers.values():
+            await buffer.wait()
+        if self._acks:
+            await asyncio.wait(list(self._acks))
+
+    def _flush_holding(self, batch: _Batch):
+        # batches are added to the buffers in order, one holding ops of the oldest batch has it first
+        for buffer in self.buffers.values():
+            if buffer.holds(batch):
+                buffer.flush()
+
+    def _buffer(self, target: str) -> WriteBuffer:
+        buffer = self.buffers.get(target)
+        if buffer is None:
+            policy = self.policies.get(target, self.default_policy)
+            buffer = self.buffers[target] = WriteBuffer(target, policy, self.write, self._ack_written)
+        return buffer
+
+    def _ack_written(self):
+        msgs = []
+        while self._batches and self._batches[0].waiting == 0 and not self.failed:
+            batch = self._batches.popleft()
+            if not batch.failed:
+                msgs.extend(batch.msgs)
+            elif self.nak is not None:
+                self._send(self.nak, batch.msgs)
+            else:
+                print("A buffered write failed, no more messages are acked")
+                self.failed = True
+                self._written.set()
+        self._send(self.ack, msgs)
+
+    def _send(self, ack: Callable[[list[Any]], Awaitable[None]], msgs: list):
+        if not msgs:
+            return
+
+        self._written.set()
+        task = asyncio.create_task(self._ack(ack, msgs))
+        self._acks.add(task)
+        task.add_done_callback(self._acks.discard)
+
+    async def _ack(self, ack: Callable[[list[Any]], Awaitable[None]], msgs: list):
+        # the lock is handed out in order, acks never overtake each other
+        async with self._ack_lock:
+            try:
+                await ack(msgs)
+            except Exception as e:
+                print(f"Error acking {len(msgs)} messages: {e}")
@@ -0,0 +1,93 @@
+import zlib
+
+from pymongo import DeleteOne, InsertOne, UpdateOne
+
+from backend.indexing import CreateDoc, DeleteDoc, ProfileUpdate, TallyInc
+
+Op = InsertOne | UpdateOne | DeleteOne
+
+
+def compact(all_ops: dict[str, list[Op]]) -> dict[str, list[Op]]:
+    """Shrinks the ops of a batch without changing what the batch writes."""
+    return {col: coalesce_tallies(merge_profile_updates(cancel_created_deleted(ops))) for col, ops in all_ops.items()}
+
+
+def coalesce_tallies(ops: list[Op]) -> list[Op]:
+    """Merges every `TallyInc` of the same post into one, summing their fields.
+
+    The merged op takes the place of the first one, all other ops keep their order.
+    """
+    merged: dict[str, dict[str, int]] = {}
+    compacted = []
+    for op in ops:
+        if not isinstance(op, TallyInc):
+            compacted.append(op)
+            continue
+
+        fields = merged.get(op.target)
+        if fields is None:
+            fields = merged[op.target] = {}
+            compacted.append(op.target)
+        for field, amount in op.fields.items():
+            fields[field] = fields.get(field, 0) + amount
+
+    return [TallyInc(op, merged[op]) if isinstance(op, str) else op for op in compacted]
+
+
+def cancel_created_deleted(ops: list[Op]) -> list[Op]:
+    """Drops the creates of documents that are deleted later in the same batch (a like and its unlike).
+
+    The delete itself is kept: the message holding the create may have been written already by an earlier delivery.
+    """
+    created: dict[str, list[int]] = {}
+    compacted = []
+    for op in ops:
+        if isinstance(op, CreateDoc):
+            created.setdefault(op.key, []).append(len(compacted))
+        elif isinstance(op, DeleteDoc):
+            for idx in created.pop(op.key, []):
+                compacted[idx] = None
+        compacted.append(op)
+
+    return [op for op in compacted if op is not None]
+
+
+def split_by_document(ops: list[Op], groups: int) -> list[list[Op]]:
+    """Splits the ops into `groups` lists that can be written in parallel.
+
+    All the ops of a document go to the same list, in their order: a profile still gets its updates in order.
+    """
+    split = [[] for _ in range(groups)]
+    for op in ops:
+        split[zlib.crc32(_document_key(op).encode()) % groups].append(op)
+    return split
+
+
+def _document_key(op: Op) -> str:
+    if isinstance(op, ProfileUpdate):
+        return op.did
+    if isinstance(op, TallyInc):
+        return op.target
+    return op.key
+
+
+def merge_profile_updates(ops: list[Op]) -> list[Op]:
+    """Merges the updates of the same profile into one, later `$set` values win.
+
+    The merged op takes the place of the first one, all other ops keep their order.
+    """
+    merged: dict[str, tuple[dict, dict | None]] = {}
+    compacted = []
+    for op in ops:
+        if not isinstance(op, ProfileUpdate):
+            compacted.append(op)
+            continue
+
+        update = merged.get(op.did)
+        if update is None:
+            # only the first update can insert the profile
+            update = merged[op.did] = ({}, op.set_on_insert)
+            compacted.append(op.did)
+        update[0].update(op.set_fields)
+
+    return [ProfileUpdate(op, *merged[op]) if isinstance(op, str) else op for op in compacted]
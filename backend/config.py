@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -9,9 +11,13 @@ class Config(BaseSettings):
     # nats
     NATS_URI: str = "nats://nats:4222"
     NATS_STREAM: str = "bsky"
-    NATS_STREAM_SUBJECT_PREFIX: str = "firehose"
+    NATS_STREAM_SUBJECT_PREFIX: str = "firehose"  # json events
+    NATS_STREAM_CBOR_SUBJECT_PREFIX: str = "firehose_cbor"  # cbor envelope events
     NATS_STREAM_MAX_AGE: int = 7  # days
     NATS_STREAM_MAX_SIZE: int = 5  # GB
+    # subjects get a `.<shard>` suffix, crc32(repo DID) % NATS_STREAM_SHARDS, 0 is unsharded; see the README before
+    # changing it
+    NATS_STREAM_SHARDS: int = 0
     # redis
     REDIS_URI: str = "redis://redis:6379"
     # mongo
@@ -22,14 +28,87 @@ class Config(BaseSettings):
     FART_KEY: str = "secret"  # if empty there is no auth
     # enjoyer
     ENJOYER_PORT: int = 8888
-    ENJOYER_CHECKPOINT: int = 1000
+    ENJOYER_CHECKPOINT: int = 1000  # frames between cursor checkpoints
+    ENJOYER_CHECKPOINT_INTERVAL: float = 1.0  # max seconds between cursor checkpoints
+    ENJOYER_SOURCE: Literal["firehose", "jetstream"] = "firehose"
+    ENJOYER_FIREHOSE_URI: str = "wss://bsky.network/xrpc"
+    ENJOYER_JETSTREAM_URI: str = "wss://jetstream2.us-east.bsky.network/subscribe"
+    ENJOYER_JETSTREAM_DICTIONARY: str = "zstd_dictionary"  # Jetstream's zstd dictionary, empty for uncompressed
+    ENJOYER_DECODE_WORKERS: int = 0  # 0 decodes inline on the event loop
+    ENJOYER_DECODE_QUEUE: int = 1000  # max frames being decoded at once
+    ENJOYER_DECODE_CHUNK: int = 50  # frames sent to a decode worker at once
+    ENJOYER_QUEUE_SIZE: int = 10000  # frames buffered in memory between the socket and the publisher
+    ENJOYER_SPOOL_DIR: str = "spool"  # frames past ENJOYER_QUEUE_SIZE are spooled to disk here
+    ENJOYER_SPOOL_MAX_SIZE: int = 4096  # MB, the socket is not read while the spool is larger
+    ENJOYER_SPOOL_SEGMENT_SIZE: int = 64  # MB of frames per spool segment
+    ENJOYER_MAX_PENDING_ACKS: int = 4000  # max publishes waiting for a JetStream ack
+    ENJOYER_PUBLISH_RETRIES: int = 3
+    ENJOYER_PUBLISH_TIMEOUT: float = 10.0  # seconds to wait for a JetStream ack before retrying the publish
+    ENJOYER_EVENT_FORMAT: Literal["json", "cbor"] = "json"
+    ENJOYER_BATCH_SIZE: int = 0  # events per message and subject, 0 publishes every event on its own
+    ENJOYER_BATCH_DELAY_MS: int = 200
+    ENJOYER_CAPTURE_SEGMENT_SIZE: int = 256  # MB of frames per capture segment
     # indexer
+    INDEXER_PORT: int = 8889
     INDEXER_ENABLE: bool = False
     INDEXER_CONSUMER: str = "indexer"
     INDEXER_BATCH_SIZE: int = 1000
+    # adaptive fetching: the batch size moves within bounds with the consumer lag and the bulk_write latency
+    INDEXER_ADAPTIVE_BATCH: bool = False
+    INDEXER_BATCH_SIZE_MIN: int = 100
+    INDEXER_BATCH_SIZE_MAX: int = 10000
+    INDEXER_FLUSH_INTERVAL_MAX_MS: int = 1000  # max wait after a partial fetch once caught up
+    INDEXER_TARGET_WRITE_MS: int = 500  # the batch shrinks while a collection takes longer to write
+    INDEXER_PARSE_WORKERS: int = 0  # 0 parses on the event loop
+    # buffered writes: ops are buffered per collection and flushed on their own size/age, messages are acked once
+    # all their ops are written; INDEXER_BUFFER_POLICIES overrides max_ops, max_age_ms and concurrency per collection
+    INDEXER_BUFFERED_WRITES: bool = False
+    INDEXER_BUFFER_MAX_OPS: int = 5000
+    INDEXER_BUFFER_MAX_AGE_MS: int = 1000
+    INDEXER_BUFFER_CONCURRENCY: int = 1  # above 1 a delete can be written before the insert it follows
+    # batches fetched and not acked yet, past it the buffers holding ops of the oldest one are flushed right away
+    INDEXER_BUFFER_MAX_BATCHES: int = 64
+    INDEXER_BUFFER_POLICIES: dict[str, dict[str, int]] = {
+        "interactions.like": {"max_ops": 20000},
+        "app.bsky.feed.post": {"max_ops": 10000},
+        "app.bsky.actor.profile": {"max_ops": 1000, "max_age_ms": 5000},
+        "app.bsky.graph.block": {"max_ops": 1000, "max_age_ms": 5000},
+    }
+    INDEXER_PIPELINE_DEPTH: int = 1  # max batches fetched and not written yet, 1 writes a batch before the next fetch
+    # several indexers can share INDEXER_CONSUMER (messages are then acked one by one) or each bind its own consumer
+    # restricted to some subjects, e.g. ["firehose.app.bsky.feed.like", "firehose_cbor.app.bsky.feed.like"]
+    INDEXER_SHARED_CONSUMER: bool = False
+    INDEXER_FILTER_SUBJECTS: list[str] = []  # empty is every subject of both prefixes
+    INDEXER_SHARD: int = 0  # shard read with NATS_STREAM_SHARDS, from the consumer `<INDEXER_CONSUMER>-<shard>`
+    # priority lanes: each reads its subjects with its own consumer `<INDEXER_CONSUMER>-<lane>`, batch_size and
+    # concurrency (parallel writes of a batch, the ops of a document stay in order), so it never waits behind a
+    # backlog of likes, not with INDEXER_FILTER_SUBJECTS, e.g.
+    # {"actors": {"subjects": ["firehose.identity", "firehose.app.bsky.actor.profile"], "batch_size": 100}}
+    # the main consumer then reads the other indexed subjects. A new lane consumer starts after the ack floor of the
+    # main consumer: stop the indexer (it acks what it wrote) before adding a lane, let a lane catch up before
+    # removing it, as the main consumer does not go back to the messages of the lane's subjects it skipped
+    INDEXER_LANES: dict[str, dict] = {}
     INDEXER_DB: str = "bsky"
+    # hourly (author, subject) rollups of the interactions, see utilities/scripts/backfill_rollups.py
+    INDEXER_ROLLUPS: bool = False
+    # in-memory filter of the stored posts, tally updates of posts surely not stored are dropped; it needs to see
+    # every post create, so it is off with INDEXER_SHARED_CONSUMER or INDEXER_FILTER_SUBJECTS
+    INDEXER_POST_FILTER: bool = False
+    INDEXER_POST_FILTER_CAPACITY: int = 10_000_000  # posts indexed per day
+    INDEXER_POST_FILTER_ERROR_RATE: float = 0.01
+    INDEXER_POST_FILTER_SNAPSHOT: str = "post_filter.bin"  # empty rebuilds it from mongo on every start
+    INDEXER_POST_FILTER_SNAPSHOT_INTERVAL: int = 600  # seconds
     # misc
     INTERACTIONS_COLLECTION: str = "interactions"
+    INTERACTIONS_FROM_ROLLUPS: bool = False  # get_interactions reads the hourly rollups instead of every interaction
+    # interactions and posts are written to per-day collections (interactions.like.2025_02_10, ...) that are dropped
+    # once expired, instead of relying on TTL indexes
+    INTERACTIONS_PARTITIONED: bool = False
+    INTERACTIONS_RETENTION_DAYS: int = 15
+    # interactions store DIDs as int64 mapped in the `dids` collection, with a binary `_id`; existing collections are
+    # converted with utilities/scripts/migrate_compact_dids.py
+    INTERACTIONS_COMPACT_DIDS: bool = False
+    DIDS_CACHE_SIZE: int = 1_000_000  # DIDs cached by the indexer and FART
     DYNAMIC_COLLECTION: str = "dynamic_data"
     CRON_TOP_INTERACTIONS: str = "0 */3 * * *"
     CRON_TOP_BLOCKS: str = "0 */3 * * *"
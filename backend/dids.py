@@ -0,0 +1,160 @@
+import collections
+from typing import Iterable
+
+from bson import Binary
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import IndexModel, ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from backend.indexing import CreateDoc, DeleteDoc
+from backend.partitions import tid_value
+
+# compact interactions: DIDs are stored as the int64 they are mapped to in the `dids` collection, `{_id: did, n: int}`.
+# Numbers are handed out in blocks from the `counters` collection so several processes can intern at once
+
+DIDS_COLLECTION = "dids"
+COUNTERS_COLLECTION = "counters"
+DIDS_INDEXES = [IndexModel("n", unique=True)]
+
+
+def interaction_id(author: int, rkey: str) -> Binary:
+    """`_id` of a compact interaction: the author number then the TID (or the raw rkey), 16 bytes for a TID."""
+    tid = tid_value(rkey)
+    suffix = tid.to_bytes(8, "big") if tid is not None else rkey.encode()
+    return Binary(author.to_bytes(8, "big", signed=True) + suffix)
+
+
+class _LRU(collections.OrderedDict):
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        if value is not default:
+            self.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self[key] = value
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class DidInterner:
+    """DID <-> int64 mapping backed by the `dids` collection, with an LRU cache of both directions."""
+
+    def __init__(self, db: AsyncIOMotorDatabase, cache_size: int = 1_000_000, block_size: int = 1000):
+        self.db = db
+        self.block_size = block_size
+        self._numbers = _LRU(cache_size)
+        self._dids = _LRU(cache_size)
+        self._next = self._end = 0
+
+    async def create_indexes(self):
+        await self.db[DIDS_COLLECTION].create_indexes(DIDS_INDEXES)
+
+    def _cache(self, did: str, number: int):
+        self._numbers.put(did, number)
+        self._dids.put(number, did)
+
+    async def lookup(self, dids: Iterable[str]) -> dict[str, int]:
+        """Numbers of the DIDs already interned, the others are left out."""
+        found = {}
+        missing = []
+        for did in set(dids):
+            number = self._numbers.get(did)
+            if number is None:
+                missing.append(did)
+            else:
+                found[did] = number
+
+        if missing:
+            async for doc in self.db[DIDS_COLLECTION].find({"_id": {"$in": missing}}):
+                self._cache(doc["_id"], doc["n"])
+                found[doc["_id"]] = doc["n"]
+        return found
+
+    async def intern(self, dids: Iterable[str]) -> dict[str, int]:
+        """Numbers of the DIDs, interning the new ones."""
+        dids = set(dids)
+        found = await self.lookup(dids)
+        missing = [did for did in dids if did not in found]
+        if not missing:
+            return found
+
+        docs = [{"_id": did, "n": await self._allocate()} for did in missing]
+        failed = set()
+        try:
+            await self.db[DIDS_COLLECTION].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+
+        for idx, doc in enumerate(docs):
+            if idx not in failed:
+                self._cache(doc["_id"], doc["n"])
+                found[doc["_id"]] = doc["n"]
+        if failed:
+            # interned by another process in the meantime: its number wins, ours is never used
+            found.update(await self.lookup(docs[idx]["_id"] for idx in failed))
+        return found
+
+    async def resolve(self, numbers: Iterable[int]) -> dict[int, str]:
+        """DIDs of the numbers, unknown numbers are left out."""
+        found = {}
+        missing = []
+        for number in set(numbers):
+            did = self._dids.get(number)
+            if did is None:
+                missing.append(number)
+            else:
+                found[number] = did
+
+        if missing:
+            async for doc in self.db[DIDS_COLLECTION].find({"n": {"$in": missing}}):
+                self._cache(doc["_id"], doc["n"])
+                found[doc["n"]] = doc["_id"]
+        return found
+
+    async def _allocate(self) -> int:
+        if self._next >= self._end:
+            counter = await self.db[COUNTERS_COLLECTION].find_one_and_update(
+                {"_id": DIDS_COLLECTION},
+                {"$inc": {"next": self.block_size}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            self._end = counter["next"] + 1
+            self._next = self._end - self.block_size
+        self._next += 1
+        return self._next - 1
+
+
+def compact_interaction(doc: dict, numbers: dict[str, int]) -> dict:
+    """Compact copy of an interaction document, `numbers` holds its author and subject."""
+    author = numbers[doc["a"]]
+    rkey = doc["_id"].partition("/")[2]
+    return {**doc, "_id": interaction_id(author, rkey), "a": author, "s": numbers[doc["s"]]}
+
+
+async def compact_interaction_ops(interner: DidInterner, ops: list) -> list:
+    """Turns the ops of an interaction collection into ops of compact documents.
+
+    Creates intern their author and subject; deletes of authors never interned have nothing to delete and are left out.
+    """
+    created = [did for op in ops if isinstance(op, CreateDoc) for did in (op.document["a"], op.document["s"])]
+    numbers = await interner.intern(created)
+    numbers.update(await interner.lookup(op.key.partition("/")[0] for op in ops if isinstance(op, DeleteDoc)))
+
+    compacted = []
+    for op in ops:
+        if isinstance(op, CreateDoc):
+            compacted.append(CreateDoc(compact_interaction(op.document, numbers)))
+        elif isinstance(op, DeleteDoc):
+            did, _, rkey = op.key.partition("/")
+            if did in numbers:
+                compacted.append(DeleteDoc(interaction_id(numbers[did], rkey)))
+        else:
+            compacted.append(op)
+    return compacted
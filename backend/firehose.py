@@ -0,0 +1,224 @@
+import json
+import logging
+from typing import Callable, Iterable
+
+import libipld
+import zstandard
+from atproto import exceptions, firehose_models, models, parse_subscribe_repos_message
+
+from backend.defaults import INTERESTED_RECORDS
+from backend.types import Commit, DecodedFrame, EventAccount, EventCommit, EventIdentity
+
+# this module must not hold any service state: decode_frame and decode_jetstream_frame are shipped to worker processes
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# one decompressor per dictionary file and process
+_jetstream_decompressors: dict[str, zstandard.ZstdDecompressor] = {}
+
+logger = logging.getLogger(__name__)
+
+
+def decode_frames(frames: list[bytes], decode: Callable[[bytes], DecodedFrame]) -> list[DecodedFrame]:
+    """Decodes a chunk of frames in one go, so a worker process is not paid a round trip per frame.
+
+    Frames that fail to decode are logged and left out.
+    """
+    decoded = []
+    for frame in frames:
+        try:
+            decoded.append(decode(frame))
+        except Exception as e:
+            logger.error(f"Error decoding frame: {e}")
+    return decoded
+
+
+def decode_frame(data: bytes) -> DecodedFrame:
+    frame = firehose_models.Frame.from_bytes(data)
+    if isinstance(frame, firehose_models.ErrorFrame):
+        raise exceptions.FirehoseError(f"{frame.body.error}: {frame.body.message}")
+
+    decoded = DecodedFrame(seq=None, events=[], car_bytes=0, car_skipped_bytes=0)
+
+    # commits are read straight from the frame body: most of them are dropped by the op paths alone
+    if frame.type == "#commit":
+        decoded["seq"] = frame.body["seq"]
+        blocks = frame.body.get("blocks") or b""
+        commits, decoded_bytes = process_commit(frame.body)
+        for commit in commits:
+            decoded["events"].append(EventCommit(kind="commit", commit=commit))
+        decoded["car_bytes"] = len(blocks)
+        decoded["car_skipped_bytes"] = len(blocks) - decoded_bytes
+        return decoded
+
+    if frame.type not in ("#account", "#identity"):
+        return decoded
+
+    parsed_message = parse_subscribe_repos_message(frame)
+    decoded["seq"] = parsed_message.seq
+
+    if isinstance(parsed_message, models.ComAtprotoSyncSubscribeRepos.Account):
+        decoded["events"].append(EventAccount(kind="account", account=parsed_message.model_dump()))
+
+    if isinstance(parsed_message, models.ComAtprotoSyncSubscribeRepos.Identity):
+        decoded["events"].append(EventIdentity(kind="identity", identity=parsed_message.model_dump()))
+
+    return decoded
+
+
+def process_commit(commit: dict) -> tuple[list[Commit], int]:
+    """Extracts the interesting ops of a raw commit body.
+
+    Only the CAR blocks referenced by interesting create/update ops are decoded, everything else is skipped
+    without being parsed. Returns the ops and the number of block bytes that were decoded.
+    """
+    repo = commit["repo"]
+    ops = []
+    wanted = {}
+    for op in commit["ops"]:
+        collection, _, rkey = op["path"].partition("/")
+
+        if collection not in INTERESTED_RECORDS:
+            continue
+
+        if op["action"] in ["create", "update"]:
+            if not op.get("cid"):
+                continue
+            wanted.setdefault(op["cid"], []).append(len(ops))
+
+        if op["action"] in ["create", "update", "delete"]:
+            ops.append(
+                {
+                    "operation": op["action"],
+                    "repo": repo,
+                    "collection": collection,
+                    "rkey": rkey,
+                }
+            )
+
+    if not wanted:
+        return ops, 0
+
+    decoded_bytes = 0
+    for cid, block in _car_blocks(commit.get("blocks") or b"", wanted.keys()).items():
+        record = libipld.decode_dag_cbor(block)
+        for idx in wanted.pop(cid):
+            ops[idx]["record"] = record
+        decoded_bytes += len(block)
+
+    # creates/updates whose block is missing from the CAR are dropped
+    if wanted:
+        missing = {idx for indexes in wanted.values() for idx in indexes}
+        ops = [op for idx, op in enumerate(ops) if idx not in missing]
+
+    return ops, decoded_bytes
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _cid_length(data: bytes, pos: int) -> int:
+    # CIDv0 is a bare sha2-256 multihash
+    if data[pos] == 0x12 and data[pos + 1] == 0x20:
+        return 34
+
+    start = pos
+    _, pos = _read_varint(data, pos)  # version
+    _, pos = _read_varint(data, pos)  # codec
+    _, pos = _read_varint(data, pos)  # multihash code
+    digest_size, pos = _read_varint(data, pos)
+    return pos + digest_size - start
+
+
+def _car_blocks(data: bytes, wanted: Iterable[bytes]) -> dict[bytes, bytes]:
+    """Walks the sections of a CARv1 file and returns the raw bytes of the wanted blocks only."""
+    wanted = set(wanted)
+    blocks = {}
+    if not data:
+        return blocks
+
+    header_size, pos = _read_varint(data, 0)
+    pos += header_size
+    while pos < len(data) and len(blocks) < len(wanted):
+        section_size, pos = _read_varint(data, pos)
+        end = pos + section_size
+        cid = data[pos : pos + _cid_length(data, pos)]
+        if cid in wanted:
+            blocks[cid] = data[pos + len(cid) : end]
+        pos = end
+
+    return blocks
+
+
+def jetstream_decompressor(dictionary_path: str) -> zstandard.ZstdDecompressor:
+    """Decompressor of the Jetstream dictionary at `dictionary_path`, loaded once per process."""
+    decompressor = _jetstream_decompressors.get(dictionary_path)
+    if decompressor is None:
+        with open(dictionary_path, "rb") as f:
+            dictionary = zstandard.ZstdCompressionDict(f.read())
+        decompressor = _jetstream_decompressors[dictionary_path] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return decompressor
+
+
+def decode_jetstream_frame(data: bytes, dictionary_path: str = "") -> DecodedFrame:
+    """Turns a Jetstream message into the same events the firehose decoder produces.
+
+    Compressed messages are zstd frames made with the Jetstream dictionary; uncompressed ones are plain JSON. The
+    Jetstream cursor (`time_us`) takes the place of the firehose seq.
+    """
+    if data[:4] == ZSTD_MAGIC:
+        data = jetstream_decompressor(dictionary_path).decompressobj().decompress(data)
+
+    message = json.loads(data)
+    decoded = DecodedFrame(seq=message.get("time_us"), events=[], car_bytes=0, car_skipped_bytes=0)
+
+    if message["kind"] == "account":
+        decoded["events"].append(EventAccount(kind="account", account=message["account"]))
+
+    if message["kind"] == "identity":
+        decoded["events"].append(EventIdentity(kind="identity", identity=message["identity"]))
+
+    if message["kind"] == "commit":
+        commit = message["commit"]
+        if commit["collection"] not in INTERESTED_RECORDS:
+            return decoded
+
+        if commit["operation"] in ["create", "update"]:
+            if not commit.get("record"):
+                return decoded
+
+            decoded["events"].append(
+                EventCommit(
+                    kind="commit",
+                    commit={
+                        "operation": commit["operation"],
+                        "repo": message["did"],
+                        "collection": commit["collection"],
+                        "rkey": commit["rkey"],
+                        "record": commit["record"],
+                    },
+                )
+            )
+
+        if commit["operation"] == "delete":
+            decoded["events"].append(
+                EventCommit(
+                    kind="commit",
+                    commit={
+                        "operation": commit["operation"],
+                        "repo": message["did"],
+                        "collection": commit["collection"],
+                        "rkey": commit["rkey"],
+                    },
+                )
+            )
+
+    return decoded
@@ -0,0 +1,433 @@
+import datetime
+import functools
+import logging
+import time
+from collections import defaultdict
+from typing import NamedTuple
+
+from atproto import AtUri, models
+from pymongo import DeleteOne, InsertOne, UpdateOne
+
+from backend.defaults import INTERACTION_RECORDS
+from backend.types import Commit, Event, EventFormat, decode_event
+
+# this module must not hold any service state: parse_messages is shipped to worker processes
+
+logger = logging.getLogger(__name__)
+
+
+class RecordFields(NamedTuple):
+    """What the interaction and tally ops need from a like, repost or post record."""
+
+    created_at: str
+    subject_uri: str | None = None  # liked or reposted post
+    reply_parent_uri: str | None = None
+    reply_root_uri: str | None = None
+    quote_uri: str | None = None
+    text_length: int = 0
+
+
+def _get_date(created_at: str | None = None):
+    # most timestamps are UTC with a Z suffix: those are truncated by their hour prefix only
+    if created_at and created_at[-1:] == "Z" and created_at[13:14] == ":":
+        return _get_hour(created_at[:13])
+
+    if created_at:
+        dt = datetime.datetime.fromisoformat(created_at)
+        # other offsets are converted first, so the hour is the UTC one like for every other record
+        dt = dt.astimezone(datetime.timezone.utc) if dt.tzinfo else dt.replace(tzinfo=datetime.timezone.utc)
+    else:
+        dt = datetime.datetime.now(tz=datetime.timezone.utc)
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_hour(hour: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(f"{hour}:00:00+00:00")
+
+
+@functools.lru_cache(maxsize=65536)
+def _get_did(uri: str) -> str:
+    """Authority of an AT-URI."""
+    if uri.startswith("at://"):
+        return uri[5:].partition("/")[0]
+    return AtUri.from_str(uri).host
+
+
+# the ops below keep what they write readable, so a batch can be compacted before bulk_write
+
+
+class CreateDoc(InsertOne):
+    """Insert of a document with its own `_id`."""
+
+    __slots__ = ("key",)
+
+    def __init__(self, document: dict):
+        super().__init__(document)
+        self.key = document["_id"]
+
+    @property
+    def document(self) -> dict:
+        return self._doc
+
+
+class DeleteDoc(DeleteOne):
+    __slots__ = ("key",)
+
+    def __init__(self, key: str):
+        super().__init__({"_id": key})
+        self.key = key
+
+
+class ProfileUpdate(UpdateOne):
+    """Upserted `$set` of a profile, `set_on_insert` only applies to new profiles."""
+
+    __slots__ = ("did", "set_fields", "set_on_insert")
+
+    def __init__(self, did: str, set_fields: dict, set_on_insert: dict | None = None):
+        update = {"$set": set_fields}
+        if set_on_insert:
+            update["$setOnInsert"] = set_on_insert
+        super().__init__({"_id": did}, update, upsert=True)
+        self.did = did
+        self.set_fields = set_fields
+        self.set_on_insert = set_on_insert
+
+
+class TallyInc(UpdateOne):
+    """`$inc` of tally fields of a post, kept readable so a batch can merge the ones hitting the same post."""
+
+    __slots__ = ("fields", "target")
+
+    def __init__(self, target: str, fields: dict[str, int]):
+        super().__init__({"_id": target}, {"$inc": fields})
+        self.target = target
+        self.fields = fields
+
+
+def _create_interaction(
+    created_at: str,
+    author: str,
+    rkey: str,
+    subject: str,
+    others: dict = {},
+):
+    if author == subject:
+        return None
+
+    return {
+        "_id": f"{author}/{rkey}",
+        "a": author,
+        "s": subject,
+        "t": _get_date(created_at),
+        **others,
+    }
+
+
+def _ref_uri(ref) -> str | None:
+    if isinstance(ref, dict):
+        uri = ref.get("uri")
+        if isinstance(uri, str):
+            return uri
+    return None
+
+
+def _extract_fields(collection: str, record: dict) -> RecordFields | None:
+    """Reads the fields straight from the raw record, None if it does not look like a valid record."""
+    created_at = record.get("createdAt")
+    if not isinstance(created_at, str):
+        return None
+
+    if collection == models.ids.AppBskyFeedLike or collection == models.ids.AppBskyFeedRepost:
+        subject_uri = _ref_uri(record.get("subject"))
+        if subject_uri is None:
+            return None
+        return RecordFields(created_at, subject_uri=subject_uri)
+
+    if collection != models.ids.AppBskyFeedPost:
+        return None
+
+    text = record.get("text")
+    if not isinstance(text, str):
+        return None
+
+    parent_uri = root_uri = quote_uri = None
+    reply = record.get("reply")
+    if reply is not None:
+        parent_uri, root_uri = _ref_uri(reply.get("parent")), _ref_uri(reply.get("root"))
+        if parent_uri is None or root_uri is None:
+            return None
+
+    embed = record.get("embed")
+    if embed is not None:
+        embed_type = embed.get("$type")
+        if embed_type == models.ids.AppBskyEmbedRecordWithMedia:
+            embed = embed.get("record")
+            embed_type = embed.get("$type") if isinstance(embed, dict) else None
+        if embed_type == models.ids.AppBskyEmbedRecord:
+            quote_uri = _ref_uri(embed.get("record"))
+            if quote_uri is None:
+                return None
+
+    return RecordFields(created_at, None, parent_uri, root_uri, quote_uri, len(text))
+
+
+def _model_fields(collection: str, raw_record: dict) -> RecordFields | None:
+    """Same as `_extract_fields` through the pydantic models, for records the fast path refused."""
+    record = models.get_or_create(raw_record, strict=False)
+    if record is None or not models.is_record_type(record, collection):
+        return None
+
+    if collection == models.ids.AppBskyFeedLike or collection == models.ids.AppBskyFeedRepost:
+        return RecordFields(record.created_at, subject_uri=record.subject.uri)
+
+    parent_uri = root_uri = quote_uri = None
+    if record.reply is not None:
+        parent_uri = record.reply.parent.uri if record.reply.parent else None
+        root_uri = record.reply.root.uri if record.reply.root else None
+
+    if record.embed is not None:
+        if models.is_record_type(record.embed, models.ids.AppBskyEmbedRecord):
+            quote_uri = record.embed.record.uri
+        if models.is_record_type(record.embed, models.ids.AppBskyEmbedRecordWithMedia) and models.is_record_type(
+            record.embed.record, models.ids.AppBskyEmbedRecord
+        ):
+            quote_uri = record.embed.record.record.uri
+
+    return RecordFields(record.created_at, None, parent_uri, root_uri, quote_uri, len(record.text))
+
+
+def _get_fields(commit: Commit) -> RecordFields | None:
+    try:
+        fields = _extract_fields(commit["collection"], commit["record"])
+    except AttributeError:
+        # a nested value that should have been an object
+        fields = None
+    if fields is None:
+        fields = _model_fields(commit["collection"], commit["record"])
+    return fields
+
+
+def _parse_create_interaction(author: str, rkey: str, collection: str, fields: RecordFields):
+    if collection == models.ids.AppBskyFeedLike or collection == models.ids.AppBskyFeedRepost:
+        return _create_interaction(fields.created_at, author, rkey, _get_did(fields.subject_uri))
+
+    if collection == models.ids.AppBskyFeedPost:
+        if fields.reply_parent_uri is not None:
+            return _create_interaction(
+                fields.created_at,
+                author,
+                rkey,
+                _get_did(fields.reply_parent_uri),
+                dict(c=fields.text_length),
+            )
+
+        if fields.quote_uri is not None:
+            return _create_interaction(
+                fields.created_at,
+                author,
+                rkey,
+                _get_did(fields.quote_uri),
+                dict(c=fields.text_length),
+            )
+
+
+def _parse_interaction(commit: Commit, fields: RecordFields | None) -> CreateDoc | DeleteDoc | None:
+    if commit["operation"] == "create":
+        if fields is None:
+            return None
+        interaction = _parse_create_interaction(commit["repo"], commit["rkey"], commit["collection"], fields)
+        if interaction:
+            return CreateDoc(interaction)
+    elif commit["operation"] == "delete":
+        return DeleteDoc("{}/{}".format(commit["repo"], commit["rkey"]))
+
+
+def _parse_profile(commit: Commit) -> ProfileUpdate:
+    if commit["operation"] == "create" or commit["operation"] == "update":
+        record = models.get_or_create(commit["record"], strict=False)
+        return ProfileUpdate(
+            commit["repo"],
+            {
+                **record.model_dump(exclude=["avatar", "banner", "py_type"]),
+                "created_at": (datetime.datetime.fromisoformat(record["created_at"]) if record["created_at"] else None),
+                "updated_at": datetime.datetime.now(tz=datetime.timezone.utc),
+            },
+            {
+                "indexed_at": datetime.datetime.now(tz=datetime.timezone.utc),
+            },
+        )
+    elif commit["operation"] == "delete":
+        return ProfileUpdate(commit["repo"], {"deleted": True})
+
+
+def _parse_block(commit: Commit) -> CreateDoc | DeleteDoc | None:
+    _id = "{}/{}/{}".format(commit["repo"], commit["collection"], commit["rkey"])
+    if commit["operation"] == "create":
+        subject, created_at = commit["record"].get("subject"), commit["record"].get("createdAt")
+        if not isinstance(subject, str) or not isinstance(created_at, str):
+            record = models.get_or_create(commit["record"], strict=False)
+            subject, created_at = record.subject, record.created_at
+        return CreateDoc(
+            {
+                "_id": _id,
+                "author": commit["repo"],
+                "subject": subject,
+                "created_at": datetime.datetime.fromisoformat(created_at),
+            }
+        )
+    elif commit["operation"] == "delete":
+        return DeleteDoc(_id)
+
+
+def update_and_inc(repo: str, target_uri: str, field: str):
+    full_field = f"tally.self_{field}" if repo in target_uri else f"tally.{field}"
+    return TallyInc(target_uri, {full_field: 1})
+
+
+def _parse_tally(commit: Commit, fields: RecordFields | None) -> list[CreateDoc | TallyInc | DeleteDoc]:
+    ops = []
+
+    operation = commit["operation"]
+    repo = commit["repo"]
+    collection = commit["collection"]
+    rkey = commit["rkey"]
+    uri = "at://{}/{}/{}".format(repo, collection, rkey)
+
+    if operation == "delete" and collection == models.ids.AppBskyFeedPost:
+        ops.append(DeleteDoc(uri))
+
+    if operation == "create":
+        if fields is None:
+            return []
+
+        if collection == models.ids.AppBskyFeedPost:
+            ops.append(
+                CreateDoc(
+                    {
+                        "_id": uri,
+                        "author": repo,
+                        "created_at": datetime.datetime.fromisoformat(fields.created_at),
+                        "indexed_at": datetime.datetime.now(tz=datetime.timezone.utc),
+                        "langs": commit["record"].get("langs", None),
+                        "reply": commit["record"].get("reply", None),
+                    }
+                )
+            )
+
+            if fields.reply_parent_uri:
+                ops.append(update_and_inc(repo, fields.reply_parent_uri, "replies"))
+            if fields.reply_root_uri:
+                ops.append(update_and_inc(repo, fields.reply_root_uri, "root_replies"))
+            if fields.quote_uri:
+                ops.append(update_and_inc(repo, fields.quote_uri, "quotes"))
+
+        if collection == models.ids.AppBskyFeedLike:
+            ops.append(update_and_inc(repo, fields.subject_uri, "likes"))
+
+        if collection == models.ids.AppBskyFeedRepost:
+            ops.append(update_and_inc(repo, fields.subject_uri, "reposts"))
+
+    return ops
+
+
+def process_event(event: Event, db_ops: dict[str, list], interactions_collection: str):
+    if event["kind"] == "account":
+        account = models.ComAtprotoSyncSubscribeRepos.Account.model_validate(event["account"], strict=False)
+        db_ops[models.ids.AppBskyActorProfile].append(
+            ProfileUpdate(
+                account.did,
+                {
+                    "active": account.active,
+                    "status": account.status,
+                    "updated_at": datetime.datetime.now(tz=datetime.timezone.utc),
+                },
+                {
+                    "indexed_at": datetime.datetime.now(tz=datetime.timezone.utc),
+                },
+            )
+        )
+
+    if event["kind"] == "identity":
+        identity = models.ComAtprotoSyncSubscribeRepos.Identity.model_validate(event["identity"], strict=False)
+        db_ops[models.ids.AppBskyActorProfile].append(
+            ProfileUpdate(
+                identity.did,
+                {
+                    "handle": identity.handle,
+                    "updated_at": datetime.datetime.now(tz=datetime.timezone.utc),
+                },
+                {
+                    "indexed_at": datetime.datetime.now(tz=datetime.timezone.utc),
+                },
+            )
+        )
+
+    if event["kind"] == "commit":
+        commit = event["commit"]
+        collection = commit["collection"]
+
+        if collection == models.ids.AppBskyActorProfile:
+            profile_op = _parse_profile(commit)
+            if profile_op:
+                db_ops[collection].append(profile_op)
+
+        if collection == models.ids.AppBskyGraphBlock:
+            block_op = _parse_block(commit)
+            if block_op:
+                db_ops[collection].append(block_op)
+
+        if collection in INTERACTION_RECORDS:
+            # the record is read once for both the tally and the interaction
+            fields = _get_fields(commit) if commit["operation"] == "create" else None
+
+            tally_ops = _parse_tally(commit, fields)
+            if len(tally_ops) > 0:
+                db_ops[models.ids.AppBskyFeedPost].extend(tally_ops)
+
+            interaction_op = _parse_interaction(commit, fields)
+            if interaction_op:
+                coll_name = "{}.{}".format(interactions_collection, collection.split(".")[-1])
+                db_ops[coll_name].append(interaction_op)
+
+
+def parse_data(data: bytes, fmt: EventFormat, db_ops: dict[str, list], interactions_collection: str):
+    payload = decode_event(data, fmt)
+    if payload["kind"] != "batch":
+        _add_event_ops(payload, db_ops, interactions_collection)
+        return
+
+    # batched messages carry several events published to the same subject
+    for event in payload["events"]:
+        try:
+            _add_event_ops(event, db_ops, interactions_collection)
+        except Exception as e:
+            logger.error(f"Error processing event: {e}; event={event}")
+
+
+def _add_event_ops(event: Event, db_ops: dict[str, list], interactions_collection: str):
+    # the ops of an event are only kept if all of them could be parsed, a tally without its interaction is not
+    event_ops = defaultdict(list)
+    process_event(event, event_ops, interactions_collection)
+    for col, ops in event_ops.items():
+        db_ops[col].extend(ops)
+
+
+def parse_messages(
+    messages: list[tuple[str, bytes]], cbor_prefix: str, interactions_collection: str
+) -> tuple[dict[str, list[InsertOne | UpdateOne | DeleteOne]], list[float]]:
+    """Parses (subject, data) pairs into the db ops of every collection, merged in message order.
+
+    Also returns how many seconds each message took, so workers can report it back.
+    """
+    db_ops = defaultdict(list)
+    durations = []
+    for subject, data in messages:
+        started = time.perf_counter()
+        fmt = "cbor" if subject.startswith(f"{cbor_prefix}.") else "json"
+        try:
+            parse_data(data, fmt, db_ops, interactions_collection)
+        except Exception as e:
+            logger.error(f"Error processing message: {e}; msg={data!r}")
+        durations.append(time.perf_counter() - started)
+    return dict(db_ops), durations
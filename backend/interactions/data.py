@@ -6,6 +6,9 @@ from motor.motor_asyncio import AsyncIOMotorDatabase
 
 from backend.config import Config
 from backend.defaults import INTERACTION_RECORDS
+from backend.dids import DidInterner
+from backend.partitions import partitions_between, union_pipeline
+from backend.rollups import ROLLUP_FIELDS, rollup_collection
 from backend.types import Interaction
 
 config = Config()
@@ -17,11 +20,70 @@ async def get_interactions(
     db: AsyncIOMotorDatabase,
     did: str,
     start_date: datetime.datetime = None,
+    interner: DidInterner | None = None,
 ) -> dict[Literal["sent", "rcvd"], list[Interaction]]:
     end_date = datetime.datetime.now(tz=datetime.timezone.utc)
     if start_date is None:
         start_date = end_date - datetime.timedelta(days=7)
 
+    # compact interactions hold the number of the DID
+    key = did
+    if config.INTERACTIONS_COMPACT_DIDS:
+        interner = interner or DidInterner(db)
+        numbers = await interner.lookup([did])
+        if did not in numbers:
+            return dict(sent=[], rcvd=[])
+        key = numbers[did]
+
+    async def _aggregate_rollups(direction: Literal["sent", "rcvd"]) -> list[Interaction]:
+        author_field = "a" if direction == "sent" else "s"
+        subject_field = "s" if direction == "sent" else "a"
+
+        pipeline = [
+            {
+                "$match": {
+                    author_field: key,
+                    "t": {
+                        "$gte": start_date,
+                    },
+                }
+            },
+            {
+                "$group": {
+                    "_id": f"${subject_field}",
+                    "l": {"$sum": "$l"},
+                    "r": {"$sum": "$r"},
+                    "p": {"$sum": "$p"},
+                    "c": {"$sum": "$c"},
+                }
+            },
+        ]
+
+        logger.info(f"starting for {did}: rollups")
+        res = {}
+        async for doc in db.get_collection(rollup_collection(config.INTERACTIONS_COLLECTION)).aggregate(pipeline):
+            res[doc["_id"]] = doc
+
+        # same subjects as the raw aggregation: the top 100 of each record type
+        top = set()
+        for field in ROLLUP_FIELDS.values():
+            ranked = sorted((doc for doc in res.values() if doc[field] > 0), key=lambda x: x[field], reverse=True)
+            top.update(doc["_id"] for doc in ranked[:100])
+
+        agg_res: list[Interaction] = [
+            Interaction(
+                _id=_id,
+                l=res[_id]["l"],
+                r=res[_id]["r"],
+                p=res[_id]["p"],
+                c=res[_id]["c"],
+                t=res[_id]["l"] + res[_id]["r"] + res[_id]["p"],
+            )
+            for _id in top
+        ]
+        agg_res.sort(key=lambda x: x["t"], reverse=True)
+        return agg_res
+
     async def _aggregate_interactions(direction: Literal["sent", "rcvd"]) -> list[Interaction]:
         author_field = "a" if direction == "sent" else "s"
         subject_field = "s" if direction == "sent" else "a"
@@ -40,22 +102,27 @@ async def get_interactions(
             if record_type == "app.bsky.feed.post":
                 agg_group["$group"]["c"] = {"$sum": "$c"}
 
-            pipeline = [
-                {
-                    "$match": {
-                        author_field: did,
-                        "t": {
-                            "$gte": start_date,
-                        },
-                    }
+            match = {
+                author_field: key,
+                "t": {
+                    "$gte": start_date,
                 },
-                agg_group,
-                {"$sort": {record_initial: -1}},
-                {"$limit": 100},
-            ]
+            }
+            collections = [collection]
+            if config.INTERACTIONS_PARTITIONED:
+                collections = partitions_between(collection, start_date, end_date)
+            pipeline = union_pipeline(
+                collections,
+                match,
+                [
+                    agg_group,
+                    {"$sort": {record_initial: -1}},
+                    {"$limit": 100},
+                ],
+            )
 
             logger.info(f"starting for {did}: {record_type}")
-            async for doc in db.get_collection(collection).aggregate(pipeline):
+            async for doc in db.get_collection(collections[0]).aggregate(pipeline):
                 res[doc["_id"]] = {**res.get(doc["_id"], {}), record_initial: doc[record_initial]}
                 if record_type == "app.bsky.feed.post":
                     res[doc["_id"]]["c"] = doc.get("c", 0)
@@ -75,7 +142,13 @@ async def get_interactions(
         agg_res.sort(key=lambda x: x["t"], reverse=True)
         return agg_res
 
-    sent = await _aggregate_interactions("sent")
-    rcvd = await _aggregate_interactions("rcvd")
+    aggregate = _aggregate_rollups if config.INTERACTIONS_FROM_ROLLUPS else _aggregate_interactions
+    sent = await aggregate("sent")
+    rcvd = await aggregate("rcvd")
+
+    if config.INTERACTIONS_COMPACT_DIDS:
+        dids = await interner.resolve(interaction["_id"] for interaction in sent + rcvd)
+        for interaction in sent + rcvd:
+            interaction["_id"] = dids.get(interaction["_id"], str(interaction["_id"]))
 
     return dict(sent=sent, rcvd=rcvd)
@@ -0,0 +1,114 @@
+import datetime
+import hashlib
+import math
+import os
+import struct
+
+# snapshot: header, then the day (proleptic ordinal) and the bits of every partition
+SNAPSHOT_MAGIC = b"PFLT"
+SNAPSHOT_HEADER = struct.Struct("<4sdIII")
+SNAPSHOT_PARTITION = struct.Struct("<I")
+
+
+def bloom_dimensions(capacity: int, error_rate: float) -> tuple[int, int]:
+    """Bits and hash count of a bloom filter holding `capacity` keys at `error_rate` false positives."""
+    size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    return size, max(1, round(size / capacity * math.log(2)))
+
+
+def bloom_positions(key: str, size: int, hashes: int) -> list[int]:
+    # double hashing of one 128-bit digest
+    digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    return [(h1 + i * h2) % size for i in range(hashes)]
+
+
+class BloomFilter:
+    """Set of strings with false positives only.
+
+    Filters of the same dimensions set the same positions for a key, so they are computed once to query many.
+    """
+
+    def __init__(self, size: int, hashes: int, bits: bytearray | None = None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray(-(-size // 8))
+
+    def add_positions(self, positions: list[int]):
+        bits = self.bits
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def has_positions(self, positions: list[int]) -> bool:
+        bits = self.bits
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class PostFilter:
+    """Post URIs indexed during the last `days` days, one bloom filter per day.
+
+    Posts expire from mongo `days` after they were indexed: the partition of a day is dropped once all of its posts
+    are gone, so the filter never grows past `days + 1` partitions. `False` means the post is surely not stored.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, days: int):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.days = days
+        self.size, self.hashes = bloom_dimensions(capacity, error_rate)
+        self.partitions: dict[int, BloomFilter] = {}
+
+    def add(self, uri: str, indexed_at: datetime.datetime | None = None):
+        day = (indexed_at or datetime.datetime.now(tz=datetime.timezone.utc)).toordinal()
+        partition = self.partitions.get(day)
+        if partition is None:
+            partition = self.partitions[day] = BloomFilter(self.size, self.hashes)
+            self.expire()
+        partition.add_positions(bloom_positions(uri, self.size, self.hashes))
+
+    def __contains__(self, uri: str) -> bool:
+        positions = bloom_positions(uri, self.size, self.hashes)
+        return any(partition.has_positions(positions) for partition in self.partitions.values())
+
+    def expire(self, now: datetime.datetime | None = None):
+        oldest = (now or datetime.datetime.now(tz=datetime.timezone.utc)).toordinal() - self.days
+        for day in [day for day in self.partitions if day < oldest]:
+            del self.partitions[day]
+
+    def save(self, path: str, saved_at: float):
+        """Writes a snapshot atomically, `saved_at` is stored to know what to catch up on after loading it."""
+        # a copy: posts keep being added while a snapshot is written from another thread
+        partitions = list(self.partitions.items())
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, saved_at, self.size, self.hashes, len(partitions)))
+            for day, partition in partitions:
+                f.write(SNAPSHOT_PARTITION.pack(day))
+                f.write(partition.bits)
+        os.replace(f"{path}.tmp", path)
+
+    def load(self, path: str) -> float | None:
+        """Loads a snapshot made with the same capacity and error rate, returns when it was saved or None."""
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "rb") as f:
+            magic, saved_at, size, hashes, count = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+            if magic != SNAPSHOT_MAGIC or size != self.size or hashes != self.hashes:
+                return None
+
+            length = -(-size // 8)
+            partitions = {}
+            for _ in range(count):
+                (day,) = SNAPSHOT_PARTITION.unpack(f.read(SNAPSHOT_PARTITION.size))
+                bits = bytearray(f.read(length))
+                if len(bits) != length:
+                    return None
+                partitions[day] = BloomFilter(size, hashes, bits)
+
+        self.partitions = partitions
+        self.expire()
+        return saved_at
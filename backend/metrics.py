@@ -0,0 +1,57 @@
+from prometheus_client import Counter
+
+
+class FastCounter:
+    """Prometheus counter for hot paths.
+
+    `inc` only bumps a plain int in a dict keyed by the label values; `flush` pushes the accumulated counts to the
+    cached label children. Once `max_labels` label combinations exist, new ones are counted under `other`.
+    """
+
+    def __init__(self, counter: Counter, max_labels: int | None = None, other: str = "other"):
+        self.counter = counter
+        self.max_labels = max_labels
+        self.other = other
+        self._children = {}
+        self._counts: dict[tuple, int] = {}
+
+    def inc(self, *labels, amount: int = 1):
+        self._counts[labels] = self._counts.get(labels, 0) + amount
+
+    @property
+    def pending(self) -> int:
+        return sum(self._counts.values())
+
+    def flush(self):
+        counts, self._counts = self._counts, {}
+        for labels, amount in counts.items():
+            self._child(labels).inc(amount)
+
+    def _child(self, labels: tuple):
+        child = self._children.get(labels)
+        if child is not None:
+            return child
+
+        if not labels:
+            child = self.counter
+        elif self.max_labels is not None and len(self._children) >= self.max_labels:
+            return self._child_other(len(labels))
+        else:
+            child = self.counter.labels(*labels)
+
+        self._children[labels] = child
+        return child
+
+    def _child_other(self, n_labels: int):
+        labels = (self.other,) * n_labels
+        child = self._children.get(labels)
+        if child is None:
+            # "other" does not count towards max_labels
+            child = self._children[labels] = self.counter.labels(*labels)
+        return child
+
+
+class FastCounters(dict[str, FastCounter]):
+    def flush(self):
+        for counter in self.values():
+            counter.flush()
@@ -0,0 +1,137 @@
+import datetime
+import re
+
+from backend.indexing import CreateDoc, DeleteDoc, TallyInc
+
+# per-day collections: `<collection>.YYYY_MM_DD` holds the records whose rkey TID was made that day. Records are
+# expired by dropping whole partitions instead of a TTL index, and a delete or a tally update finds the partition of
+# its record from the rkey alone
+
+TID_ALPHABET = "234567abcdefghijklmnopqrstuvwxyz"
+_TID_VALUES = {char: value for value, char in enumerate(TID_ALPHABET)}
+PARTITION_SUFFIX = re.compile(r"\.(\d{4})_(\d{2})_(\d{2})$")
+
+
+def tid_value(rkey: str) -> int | None:
+    """64-bit value of a TID record key, None if it is not a TID."""
+    if len(rkey) != 13:
+        return None
+    value = 0
+    for char in rkey:
+        digit = _TID_VALUES.get(char)
+        if digit is None:
+            return None
+        value = value << 5 | digit
+    if value >> 63:
+        return None
+    return value
+
+
+def tid_day(rkey: str) -> datetime.date | None:
+    """UTC day of the timestamp of a TID record key, None if it is not a TID."""
+    value = tid_value(rkey)
+    if value is None:
+        return None
+    # 53 bits of microseconds then 10 bits of clock id
+    return datetime.datetime.fromtimestamp((value >> 10) / 1e6, tz=datetime.timezone.utc).date()
+
+
+def partition_name(collection: str, day: datetime.date) -> str:
+    return f"{collection}.{day:%Y_%m_%d}"
+
+
+def partition_day(collection: str, name: str) -> datetime.date | None:
+    if not name.startswith(f"{collection}."):
+        return None
+    match = PARTITION_SUFFIX.search(name)
+    if match is None or match.start() != len(collection):
+        return None
+    return datetime.date(*map(int, match.groups()))
+
+
+def partitions_between(collection: str, start: datetime.datetime, end: datetime.datetime) -> list[str]:
+    """Partitions that can hold records with a time in [start, end].
+
+    A record time (`t`, `created_at`) comes from the record itself and is close to its TID, a day of margin is
+    taken on both sides. The unpartitioned collection is included: it still holds what was written before
+    partitioning was turned on, until its TTL index empties it.
+    """
+    day, last = (start - datetime.timedelta(days=1)).date(), (end + datetime.timedelta(days=1)).date()
+    names = [collection]
+    while day <= last:
+        names.append(partition_name(collection, day))
+        day += datetime.timedelta(days=1)
+    return names
+
+
+def union_pipeline(collections: list[str], match: dict, stages: list[dict]) -> list[dict]:
+    """Pipeline to run on `collections[0]` matching `match` in all of them, followed by `stages`."""
+    return [
+        {"$match": match},
+        *[{"$unionWith": {"coll": collection, "pipeline": [{"$match": match}]}} for collection in collections[1:]],
+        *stages,
+    ]
+
+
+def _record_key(op) -> str | None:
+    if isinstance(op, (CreateDoc, DeleteDoc)):
+        return op.key
+    if isinstance(op, TallyInc):
+        return op.target
+    return None
+
+
+class PartitionRouter:
+    """Sends the ops of partitioned collections to their per-day partitions.
+
+    `retention` is how many days of partitions each collection keeps. Ops of records outside of it (or dated in the
+    future) are dropped: their partition is expired or would never be. Ops without a TID rkey go to the partition of
+    their document date when they create one, otherwise to every partition.
+    """
+
+    def __init__(self, retention: dict[str, int]):
+        self.retention = retention
+        self.known: dict[str, set[datetime.date]] = {collection: set() for collection in retention}
+
+    def add_known(self, names: list[str]):
+        for collection, days in self.known.items():
+            for name in names:
+                day = partition_day(collection, name)
+                if day is not None:
+                    days.add(day)
+
+    def route(self, collection: str, ops: list, today: datetime.date | None = None) -> tuple[dict[str, list], int]:
+        """Ops per partition name, and how many were dropped."""
+        today = today or datetime.datetime.now(tz=datetime.timezone.utc).date()
+        first, last = today - datetime.timedelta(days=self.retention[collection]), today + datetime.timedelta(days=1)
+        routed: dict[str, list] = {}
+        dropped = 0
+        for op in ops:
+            key = _record_key(op)
+            day = tid_day(key.rpartition("/")[2]) if key else None
+            if day is None and isinstance(op, CreateDoc):
+                date = op.document.get("t") or op.document.get("created_at")
+                day = date.astimezone(datetime.timezone.utc).date() if date else None
+
+            if day is None:
+                days = [day for day in self.known[collection] if first <= day <= last]
+            elif first <= day <= last:
+                days = (day,)
+            else:
+                dropped += 1
+                continue
+
+            for day in days:
+                routed.setdefault(partition_name(collection, day), []).append(op)
+        return routed, dropped
+
+    def expired(self, today: datetime.date | None = None) -> list[str]:
+        """Partitions past their retention, forgotten once returned so they can be dropped."""
+        today = today or datetime.datetime.now(tz=datetime.timezone.utc).date()
+        names = []
+        for collection, days in self.known.items():
+            first = today - datetime.timedelta(days=self.retention[collection])
+            for day in sorted(day for day in days if day < first):
+                days.discard(day)
+                names.append(partition_name(collection, day))
+        return names
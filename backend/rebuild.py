@@ -0,0 +1,107 @@
+import asyncio
+import datetime
+from typing import Callable
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import IndexModel
+from pymongo.errors import BulkWriteError
+
+from backend.indexing import CreateDoc, DeleteDoc
+
+REBUILD_SUFFIX = ".rebuild"
+
+
+class RebuildWriter:
+    """Writes the interaction ops of a stream replay to fresh copies of their collections, swapped in by `finish`.
+
+    Creates are inserted unordered in indexless `<collection>.rebuild` copies. Deletes are set aside in a side
+    collection and applied in bulk at the end: a delete always comes after its create in the stream and record keys
+    are not reused.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase):
+        self.db = db
+        self.targets: set[str] = set()
+        # duplicate keys are not counted: a replayed stream can hold an event twice
+        self.errors = 0
+
+    @staticmethod
+    def copy_name(target: str) -> str:
+        return f"{target}{REBUILD_SUFFIX}"
+
+    async def clear(self):
+        """Drops the copies left by an interrupted rebuild."""
+        for name in await self.db.list_collection_names():
+            if name.endswith(REBUILD_SUFFIX) or f"{REBUILD_SUFFIX}." in name:
+                await self.db.drop_collection(name)
+
+    async def write(self, target: str, ops: list):
+        self.targets.add(target)
+        copy = self.copy_name(target)
+
+        await asyncio.gather(
+            self._insert(copy, [op.document for op in ops if isinstance(op, CreateDoc)]),
+            self._insert(f"{copy}.deletes", [{"_id": op.key} for op in ops if isinstance(op, DeleteDoc)]),
+        )
+
+    async def _insert(self, collection: str, docs: list[dict]):
+        if not docs:
+            return
+        try:
+            await self.db[collection].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            self.errors += sum(error.get("code") != 11000 for error in e.details.get("writeErrors", []))
+
+    async def finish(
+        self,
+        indexes: Callable[[str], list[IndexModel]],
+        kept_before: datetime.datetime | None,
+        log: Callable[[str], None] = print,
+    ):
+        """Applies the deletes, builds the indexes and renames every copy over its collection.
+
+        The documents of a collection with a `t` before `kept_before` are copied first: the stream does not go back
+        that far, so without them the swap would lose every day the collection keeps past the replay.
+        """
+        names = set(await self.db.list_collection_names())
+        copies = []
+        for target in sorted(self.targets):
+            copy = self.copy_name(target)
+            if copy not in names:
+                # nothing was created in it, the collection is left alone
+                continue
+
+            if kept_before is not None:
+                log(f"Keeping the documents of {target} before {kept_before}")
+                pipeline = [
+                    {"$match": {"t": {"$lt": kept_before}}},
+                    {"$merge": {"into": copy, "whenMatched": "keepExisting", "whenNotMatched": "insert"}},
+                ]
+                async for _ in self.db[target].aggregate(pipeline, allowDiskUse=True):
+                    pass
+
+            if f"{copy}.deletes" in names:
+                keys = []
+                async for doc in self.db[f"{copy}.deletes"].find({}, batch_size=10000):
+                    keys.append(doc["_id"])
+                    if len(keys) >= 10000:
+                        await self.db[copy].delete_many({"_id": {"$in": keys}})
+                        keys = []
+                if keys:
+                    await self.db[copy].delete_many({"_id": {"$in": keys}})
+
+            log(f"Building the indexes of {copy}")
+            if indexes(target):
+                await self.db[copy].create_indexes(indexes(target))
+            copies.append((copy, target))
+
+        # each rename atomically replaces one collection, readers never see a half built one
+        for copy, target in copies:
+            await self.db.client.admin.command(
+                "renameCollection", f"{self.db.name}.{copy}", to=f"{self.db.name}.{target}", dropTarget=True
+            )
+            log(f"Swapped {target}")
+
+        for name in names:
+            if f"{REBUILD_SUFFIX}." in name:
+                await self.db.drop_collection(name)
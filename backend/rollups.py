@@ -0,0 +1,135 @@
+import datetime
+from typing import Iterable
+
+from pymongo import IndexModel, UpdateOne
+
+from backend.defaults import INTERACTION_RECORDS
+from backend.partitions import union_pipeline
+
+# hourly rollups of the interaction collections: one document per (author, subject, hour) holding the likes (l),
+# reposts (r), replies/quotes (p) and their characters (c) that author sent to that subject in that hour
+
+ROLLUP_FIELDS = {
+    "like": "l",
+    "repost": "r",
+    "post": "p",
+}
+
+ROLLUP_INDEXES = [
+    IndexModel(["a", "t"]),
+    IndexModel(["s", "t"]),
+    IndexModel("t", expireAfterSeconds=60 * 60 * 24 * 15),
+]
+
+
+def rollup_collection(interactions_collection: str) -> str:
+    return f"{interactions_collection}.hourly"
+
+
+def rollup_fields(interactions_collection: str) -> dict[str, str]:
+    """Interaction collection -> the rollup counter its documents are counted in."""
+    return {
+        "{}.{}".format(interactions_collection, record_type.split(".")[-1]): ROLLUP_FIELDS[record_type.split(".")[-1]]
+        for record_type in INTERACTION_RECORDS
+    }
+
+
+def rollup_key(author: str | int, subject: str | int, hour: datetime.datetime) -> str:
+    # must match the `_id` built by `backfill_pipeline`, DIDs are numbers with INTERACTIONS_COMPACT_DIDS. That is the
+    # UTC hour: documents read back from mongo are naive UTC, aware ones are converted
+    if hour.tzinfo is not None:
+        hour = hour.astimezone(datetime.timezone.utc)
+    return f"{author}/{subject}/{hour:%Y%m%d%H}"
+
+
+class RollupInc(UpdateOne):
+    """Upserted `$inc` of the counters of an (author, subject, hour) rollup."""
+
+    __slots__ = ("fields", "key")
+
+    def __init__(self, key: str, author: str, subject: str, hour: datetime.datetime, fields: dict[str, int]):
+        super().__init__(
+            {"_id": key},
+            {"$inc": fields, "$setOnInsert": {"a": author, "s": subject, "t": hour}},
+            upsert=True,
+        )
+        self.key = key
+        self.fields = fields
+
+
+def rollup_incs(field: str, created: Iterable[dict], deleted: Iterable[dict]) -> list[RollupInc]:
+    """Counts inserted interaction documents in and deleted ones out, one op per rollup.
+
+    Only documents actually written must be passed: a redelivered create fails on its duplicate `_id` and a
+    redelivered delete finds nothing, so neither is counted twice.
+    """
+    merged: dict[str, tuple[dict, dict[str, int]]] = {}
+    for docs, sign in ((created, 1), (deleted, -1)):
+        for doc in docs:
+            key = rollup_key(doc["a"], doc["s"], doc["t"])
+            fields = merged.setdefault(key, (doc, {}))[1]
+            fields[field] = fields.get(field, 0) + sign
+            if "c" in doc:
+                fields["c"] = fields.get("c", 0) + sign * doc["c"]
+
+    ops = []
+    for key, (doc, fields) in merged.items():
+        fields = {name: amount for name, amount in fields.items() if amount}
+        if fields:
+            ops.append(RollupInc(key, doc["a"], doc["s"], doc["t"], fields))
+    return ops
+
+
+def backfill_pipeline(
+    record_type: str,
+    interactions_collection: str,
+    since: datetime.datetime | None,
+    until: datetime.datetime,
+    collections: list[str],
+) -> list[dict]:
+    """Aggregation rebuilding the rollup counter of `record_type` from its raw collections, run on the first one.
+
+    The counter of every rollup in [since, until) is replaced, the counters of the other record types are kept.
+    """
+    field = ROLLUP_FIELDS[record_type.split(".")[-1]]
+    hours = {"$lt": until}
+    if since is not None:
+        hours["$gte"] = since
+
+    group = {"_id": {"a": "$a", "s": "$s", "t": "$t"}, field: {"$sum": 1}}
+    counters = {field: f"$$new.{field}"}
+    if field == "p":
+        group["c"] = {"$sum": "$c"}
+        counters["c"] = "$$new.c"
+
+    return union_pipeline(
+        collections,
+        {"t": hours},
+        [
+            {"$group": group},
+            {
+                "$project": {
+                    "_id": {
+                        "$concat": [
+                            {"$toString": "$_id.a"},
+                            "/",
+                            {"$toString": "$_id.s"},
+                            "/",
+                            {"$dateToString": {"date": "$_id.t", "format": "%Y%m%d%H"}},
+                        ]
+                    },
+                    "a": "$_id.a",
+                    "s": "$_id.s",
+                    "t": "$_id.t",
+                    **{name: 1 for name in counters},
+                }
+            },
+            {
+                "$merge": {
+                    "into": rollup_collection(interactions_collection),
+                    "whenMatched": [{"$set": counters}],
+                    "whenNotMatched": "insert",
+                }
+            },
+        ],
+    )
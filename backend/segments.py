@@ -0,0 +1,238 @@
+import asyncio
+import collections
+import glob
+import os
+import struct
+import time
+from typing import BinaryIO, Iterator
+
+import zstandard
+
+# every record is the receive time, the frame size and the raw frame bytes
+RECORD_HEADER = struct.Struct("<dI")
+
+
+class SegmentWriter:
+    """Appends raw frames to numbered segment files, rotating once a segment holds `max_bytes` of frames."""
+
+    def __init__(self, directory: str, prefix: str = "frames", max_bytes: int = 256 * 1024 * 1024, compress=True):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.path: str | None = None
+        self._file: BinaryIO | None = None
+        self._raw_file: BinaryIO | None = None
+        self.size = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, frame: bytes, received_at: float | None = None):
+        if self._file is None or self.size >= self.max_bytes:
+            self._open_segment()
+
+        self._file.write(RECORD_HEADER.pack(received_at or time.time(), len(frame)))
+        self._file.write(frame)
+        self.size += RECORD_HEADER.size + len(frame)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            if self._raw_file is not self._file:
+                self._raw_file.close()
+        self._file = None
+        self._raw_file = None
+        self.path = None
+        self.size = 0
+
+    def _open_segment(self):
+        self.close()
+        extension = ".seg.zst" if self.compress else ".seg"
+        # nanosecond names keep segments sorted in write order
+        self.path = os.path.join(self.directory, f"{self.prefix}-{time.time_ns()}{extension}")
+        # open across writes, closed by `close` (which rotation and the owner call)
+        self._raw_file = open(self.path, "wb")  # noqa: SIM115
+        if self.compress:
+            self._file = zstandard.ZstdCompressor(level=3).stream_writer(self._raw_file)
+        else:
+            self._file = self._raw_file
+
+
+def list_segments(path: str, prefix: str = "frames") -> list[str]:
+    """Segment files of a directory in write order, or the file itself."""
+    if os.path.isdir(path):
+        return sorted(
+            glob.glob(os.path.join(path, f"{prefix}-*.seg.zst")) + glob.glob(os.path.join(path, f"{prefix}-*.seg")),
+            key=lambda name: int(os.path.basename(name).split("-")[-1].split(".")[0]),
+        )
+    return [path]
+
+
+def read_segment(path: str) -> Iterator[tuple[float, bytes]]:
+    """Yields (received_at, frame) for every complete record of a segment, a truncated tail is ignored."""
+    with open(path, "rb") as raw_file:
+        if path.endswith(".zst"):
+            file = zstandard.ZstdDecompressor().stream_reader(raw_file, read_across_frames=True)
+        else:
+            file = raw_file
+
+        while True:
+            header = _read_exactly(file, RECORD_HEADER.size)
+            if header is None:
+                return
+            received_at, size = RECORD_HEADER.unpack(header)
+            frame = _read_exactly(file, size)
+            if frame is None:
+                return
+            yield received_at, frame
+
+
+def _read_exactly(file: BinaryIO, size: int) -> bytes | None:
+    chunks = []
+    while size > 0:
+        try:
+            chunk = file.read(size)
+        except zstandard.ZstdError:
+            return None
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+class SpooledQueue:
+    """FIFO of frames that never blocks the producer.
+
+    Frames are kept in memory up to `maxsize`. Past that they are appended to uncompressed segments in `directory`
+    until the consumer has drained the whole spool, so frames always come out in the order they were put. The disk
+    IO runs in a thread, frames are spooled in chunks as they come and read back `read_chunk` at a time, so the
+    event loop is not stalled while the consumer is behind. Once closed, `get` returns None after the last frame.
+    """
+
+    def __init__(self, maxsize: int, directory: str, segment_size: int = 64 * 1024 * 1024, read_chunk: int = 256):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.segment_size = segment_size
+        self.read_chunk = read_chunk
+        self.spool_size = 0
+        # in order: frames put before spooling started, frames read back, the spool, frames waiting to be spooled
+        self._memory: collections.deque[bytes] = collections.deque()
+        self._read: collections.deque[bytes] = collections.deque()
+        self._unspooled: collections.deque[bytes] = collections.deque()
+        self._writer: SegmentWriter | None = None
+        self._segments: collections.deque[str] = collections.deque()
+        self._reading: str | None = None
+        self._reader: Iterator[tuple[float, bytes]] | None = None
+        # held while the thread reads or writes the spool
+        self._io = asyncio.Lock()
+        self._spool_task: asyncio.Task | None = None
+        self._available = asyncio.Event()
+        self._closed = False
+
+        # whatever was spooled by a previous run is covered by the saved cursor
+        if os.path.isdir(directory):
+            for segment in list_segments(directory, prefix="spool"):
+                os.remove(segment)
+
+    def __len__(self) -> int:
+        return len(self._memory)
+
+    @property
+    def spooling(self) -> bool:
+        # a running spool task may hold frames on their way to the disk
+        return self._writer is not None or self._spool_task is not None or bool(self._unspooled or self._read)
+
+    def close(self):
+        self._closed = True
+        self._available.set()
+
+    def put_nowait(self, frame: bytes):
+        if not self.spooling and len(self._memory) < self.maxsize:
+            self._memory.append(frame)
+        else:
+            self._unspooled.append(frame)
+            self.spool_size += RECORD_HEADER.size + len(frame)
+            if self._spool_task is None:
+                self._spool_task = asyncio.create_task(self._spool())
+        self._available.set()
+
+    async def get(self) -> bytes | None:
+        while True:
+            frame = self.get_nowait()
+            if frame is not None:
+                return frame
+
+            if self._writer is not None or self._io.locked():
+                async with self._io:
+                    if self._writer is not None:
+                        self._read.extend(await asyncio.to_thread(self._read_spool, self.read_chunk))
+                continue
+
+            if self._closed:
+                return None
+
+            self._available.clear()
+            await self._available.wait()
+
+    def get_nowait(self) -> bytes | None:
+        """The next frame if it is in memory, None otherwise."""
+        if self._memory:
+            return self._memory.popleft()
+        if self._read:
+            frame = self._read.popleft()
+        elif self._unspooled and self._writer is None and not self._io.locked():
+            # the spool is drained and nothing is being written to it: these frames come next
+            frame = self._unspooled.popleft()
+        else:
+            return None
+        self.spool_size -= RECORD_HEADER.size + len(frame)
+        return frame
+
+    async def _spool(self):
+        try:
+            async with self._io:
+                while self._unspooled:
+                    frames = list(self._unspooled)
+                    self._unspooled.clear()
+                    await asyncio.to_thread(self._write_spool, frames)
+        finally:
+            self._spool_task = None
+
+    def _write_spool(self, frames: list[bytes]):
+        if self._writer is None:
+            self._writer = SegmentWriter(self.directory, prefix="spool", max_bytes=self.segment_size, compress=False)
+        for frame in frames:
+            path = self._writer.path
+            self._writer.write(frame)
+            if path is not None and self._writer.path != path:
+                # rotated: the previous segment is complete
+                self._segments.append(path)
+
+    def _read_spool(self, count: int) -> list[bytes]:
+        frames = []
+        while self._writer is not None and len(frames) < count:
+            if self._reader is None:
+                if not self._segments:
+                    if self._writer.path is None:
+                        # fully drained, back to memory only
+                        self._writer = None
+                        break
+                    # the segment being written is closed so it can be read back
+                    self._segments.append(self._writer.path)
+                    self._writer.close()
+                self._reading = self._segments.popleft()
+                self._reader = read_segment(self._reading)
+
+            record = next(self._reader, None)
+            if record is not None:
+                frames.append(record[1])
+                continue
+
+            os.remove(self._reading)
+            self._reader = None
+            self._reading = None
+        return frames
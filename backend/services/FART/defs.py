@@ -12,6 +12,7 @@ from fastapi import FastAPI
 from pymongo.errors import ConnectionFailure
 
 from backend.config import Config
+from backend.dids import DidInterner
 
 config = Config()
 logger = logging.getLogger("uvicorn.error")
@@ -30,6 +31,7 @@ class FARTContext:
     mongo: motor.motor_asyncio.AsyncIOMotorClient
     db: motor.motor_asyncio.AsyncIOMotorDatabase
     cache: "redis.Redis"
+    dids: DidInterner
 
     def __init__(self):
         self.resolver = AsyncIdResolver(cache=AsyncDidInMemoryCache())
@@ -37,6 +39,7 @@ class FARTContext:
         self.mongo = motor.motor_asyncio.AsyncIOMotorClient(config.MONGO_URI, compressors="zstd")
         self.db = self.mongo.get_database(config.FART_DB)
         self.cache = redis.from_url(config.REDIS_URI, decode_responses=True)
+        self.dids = DidInterner(self.db, config.DIDS_CACHE_SIZE)
 
     async def connect(self):
         try:
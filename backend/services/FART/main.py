@@ -11,6 +11,7 @@ from pydantic import BaseModel
 from backend.config import Config
 from backend.types import Interaction
 from backend.interactions.data import get_interactions
+from backend.partitions import partition_day
 
 from . import aux
 from .auth import get_api_key
@@ -56,6 +57,7 @@ async def _fetch_dynamic_data(
 @app.get("/collStats")
 async def _get_collstats():
     collStats = {}
+    names = await app.ctx.db.list_collection_names() if config.INTERACTIONS_PARTITIONED else []
     for collection in [
         "app.bsky.actor.profile",
         "app.bsky.graph.block",
@@ -63,8 +65,10 @@ async def _get_collstats():
         "interactions.post",
         "interactions.repost",
     ]:
-        async for doc in app.ctx.db.get_collection(collection).aggregate([{"$collStats": {"count": {}}}]):
-            collStats[collection] = doc["count"]
+        # partitions are counted with their collection
+        for name in [collection] + [name for name in names if partition_day(collection, name)]:
+            async for doc in app.ctx.db.get_collection(name).aggregate([{"$collStats": {"count": {}}}]):
+                collStats[collection] = collStats.get(collection, 0) + doc["count"]
 
     return collStats
 
@@ -99,7 +103,7 @@ async def _interactions(body: InteractionsBody, api_key: APIKeyHeader = Depends(
     logger.info(f"[interactions] fetching: {handle}@{did}")
 
     await app.ctx.cache_hset("interactions:semaphore", did, {}, ttl=600)
-    data = await get_interactions(app.ctx.db, did)
+    data = await get_interactions(app.ctx.db, did, interner=app.ctx.dids)
     await app.ctx.cache_hset("interactions:data", did, data, ttl=600)
     await app.ctx.cache_hdel("interactions:semaphore", did)
 
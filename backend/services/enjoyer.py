@@ -1,131 +1,248 @@
 import argparse
 import asyncio
+import concurrent.futures
+import functools
+import resource
 import signal
 import time
 from types import FrameType
-from typing import Any
+from typing import AsyncIterator
+from urllib.parse import urlencode
 
 import nats
 import nats.js.errors
 import uvicorn
-from atproto import (
-    CAR,
-    AsyncFirehoseSubscribeReposClient,
-    AtUri,
-    firehose_models,
-    models,
-    parse_subscribe_repos_message,
-)
-from prometheus_client import Counter, make_asgi_app
+import websockets
+import zstandard
+from atproto import models
+from prometheus_client import Counter, Gauge, make_asgi_app
 
 from backend.config import Config
 from backend.defaults import INTERESTED_RECORDS
+from backend.firehose import decode_frame, decode_frames, decode_jetstream_frame, jetstream_decompressor
 from backend.logger import Logger
-from backend.stream import NATSManager
-from backend.types import (
-    Commit,
-    EventAccount,
-    EventCommit,
-    EventIdentity,
-)
+from backend.metrics import FastCounter, FastCounters
+from backend.segments import SegmentWriter, SpooledQueue, list_segments, read_segment
+from backend.stream import BatchPublisher, Checkpointer, NATSManager, did_shard
+from backend.types import DecodedFrame, Event, encode_event
 
 app = make_asgi_app()
 _config = Config()
-nm = NATSManager(uri=_config.NATS_URI, stream=_config.NATS_STREAM)
-client = AsyncFirehoseSubscribeReposClient()
-
-counters = dict(
-    network=Counter("firehose_network", "data received"),
-    events=Counter("firehose_events", "events"),
-    post_langs=Counter("firehose_post_langs", "post languages", ["lang"]),
-    account=Counter("firehose_account_counter", "account updates", ["active", "status"]),
-    identity=Counter("firehose_identity_counter", "identity updates"),
-    firehose=Counter("firehose", "firehose", ["operation", "collection"]),
+nm = NATSManager(
+    uri=_config.NATS_URI,
+    stream=_config.NATS_STREAM,
+    max_pending=_config.ENJOYER_MAX_PENDING_ACKS,
+    max_retries=_config.ENJOYER_PUBLISH_RETRIES,
+    publish_timeout=_config.ENJOYER_PUBLISH_TIMEOUT,
+)
+stop_event = asyncio.Event()
+
+# hot path counters are accumulated locally and pushed to prometheus once per second
+counters = FastCounters(
+    network=FastCounter(Counter("firehose_network", "data received")),
+    events=FastCounter(Counter("firehose_events", "events")),
+    post_langs=FastCounter(Counter("firehose_post_langs", "post languages", ["lang"]), max_labels=64),
+    account=FastCounter(Counter("firehose_account_counter", "account updates", ["active", "status"]), max_labels=32),
+    identity=FastCounter(Counter("firehose_identity_counter", "identity updates")),
+    firehose=FastCounter(Counter("firehose", "firehose", ["operation", "collection"]), max_labels=32),
+    car_bytes=FastCounter(Counter("firehose_car_bytes", "commit CAR bytes received")),
+    car_skipped_bytes=FastCounter(Counter("firehose_car_skipped_bytes", "commit CAR bytes skipped without decoding")),
 )
+publish_errors = Counter("firehose_publish_errors", "messages not persisted after all retries")
+queue_gauges = {
+    "depth": Gauge("firehose_queue_depth", "frames waiting in memory to be processed"),
+    "spool_size": Gauge("firehose_spool_bytes", "bytes of frames waiting in the disk spool"),
+}
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--log", default="INFO")
+parser.add_argument("--capture", metavar="DIR", help="also write the raw firehose frames to segment files in DIR")
+parser.add_argument("--replay", metavar="PATH", help="read frames from a capture segment or directory of segments")
+parser.add_argument(
+    "--replay-speed", type=float, default=0, help="multiple of real time for --replay, 0 is as fast as possible"
+)
 args = parser.parse_args()
 logger = Logger("indexer", level=args.log.upper())
 
 
 async def signal_handler(_: int, __: FrameType) -> None:
     logger.info("Shutting down...")
-    await client.stop()
+    stop_event.set()
+
 
+async def flush_counters() -> None:
+    while not stop_event.is_set():
+        await asyncio.sleep(1)
+        logger.debug(f"NETWORK LOAD: {counters['events'].pending}/s")
+        counters.flush()
 
-def get_nats_subject(collection: str) -> str:
-    return f"{_config.NATS_STREAM_SUBJECT_PREFIX}.{collection}"
 
+def get_nats_subject(collection: str, did: str) -> str:
+    if _config.ENJOYER_EVENT_FORMAT == "cbor":
+        subject = f"{_config.NATS_STREAM_CBOR_SUBJECT_PREFIX}.{collection}"
+    else:
+        subject = f"{_config.NATS_STREAM_SUBJECT_PREFIX}.{collection}"
+    if _config.NATS_STREAM_SHARDS:
+        return f"{subject}.{did_shard(did, _config.NATS_STREAM_SHARDS)}"
+    return subject
 
-async def subscribe_to_firehose(nm: NATSManager):
+
+async def websocket_frames(base_uri: str, params: dict) -> AsyncIterator[bytes]:
+    reconnect_no = 0
+    while not stop_event.is_set():
+        try:
+            if reconnect_no != 0:
+                await asyncio.sleep(min(2**reconnect_no, 64))
+
+            # params are read on every reconnection, the cursor is kept up to date by the checkpoints
+            uri = base_uri
+            if params:
+                uri = f"{uri}?{urlencode(params, doseq=True)}"
+
+            async with websockets.connect(uri, max_size=5 * 1024 * 1024, close_timeout=0.1) as websocket:
+                logger.info(f"Connected to {uri}")
+                reconnect_no = 0
+                while not stop_event.is_set():
+                    frame = await asyncio.wait_for(websocket.recv(), timeout=30)
+                    if isinstance(frame, str):
+                        frame = frame.encode()
+                    counters["network"].inc(amount=len(frame))
+                    yield frame
+        except (websockets.exceptions.WebSocketException, asyncio.TimeoutError, OSError) as e:
+            logger.error(f"Connection to {base_uri} lost: {e}")
+            reconnect_no += 1
+
+
+async def replay_frames(path: str, speed: float = 0) -> AsyncIterator[bytes]:
+    started = time.monotonic()
+    first_received_at = None
+    for segment in list_segments(path):
+        logger.info(f"Replaying {segment}")
+        for received_at, frame in read_segment(segment):
+            if stop_event.is_set():
+                return
+
+            if speed > 0:
+                first_received_at = first_received_at or received_at
+                delay = (received_at - first_received_at) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            counters["network"].inc(amount=len(frame))
+            yield frame
+            # let the publisher and metrics tasks run when replaying as fast as possible
+            await asyncio.sleep(0)
+
+
+async def capture_frames(frames: AsyncIterator[bytes], directory: str) -> AsyncIterator[bytes]:
+    writer = SegmentWriter(directory, max_bytes=_config.ENJOYER_CAPTURE_SEGMENT_SIZE * 1024 * 1024)
+    logger.info(f"Capturing frames to {directory}")
+    try:
+        async for frame in frames:
+            writer.write(frame)
+            yield frame
+    finally:
+        writer.close()
+
+
+async def receive_frames(frames: AsyncIterator[bytes], queue: SpooledQueue) -> None:
+    max_spool_size = _config.ENJOYER_SPOOL_MAX_SIZE * 1024 * 1024
+    try:
+        async for frame in frames:
+            queue.put_nowait(frame)
+            if queue.spool_size > max_spool_size:
+                logger.warning(f"Spool is over {_config.ENJOYER_SPOOL_MAX_SIZE}MB, pausing the receiver")
+                while queue.spool_size > max_spool_size and not stop_event.is_set():
+                    await asyncio.sleep(0.1)
+    finally:
+        queue.close()
+
+
+async def subscribe_to_firehose(nm: NATSManager) -> int:
     kv = await nm.get_or_create_kv_store(_config.NATS_STREAM)
+    # firehose seqs and jetstream timestamps are not interchangeable
+    cursor_key = "cursor" if _config.ENJOYER_SOURCE == "firehose" else "jetstream_cursor"
 
     async def get_cursor():
         try:
-            cursor = await kv.get("cursor")
+            cursor = await kv.get(cursor_key)
             cursor = int(cursor.value)
         except nats.js.errors.KeyNotFoundError:
             cursor = ""
         return cursor
 
-    def measure_events_per_second(func: callable) -> callable:
-        def wrapper(*args) -> Any:
-            wrapper.calls += 1
-            cur_time = time.time()
-
-            if cur_time - wrapper.start_time >= 1:
-                counters["events"].inc(wrapper.calls)
-                logger.debug(f"NETWORK LOAD: {wrapper.calls}/s")
-                wrapper.start_time = cur_time
-                wrapper.calls = 0
-
-            return func(*args)
-
-        wrapper.calls = 0
-        wrapper.start_time = time.time()
-
-        return wrapper
-
-    @measure_events_per_second
-    async def on_message_handler(message: firehose_models.MessageFrame) -> None:
-        parsed_message = parse_subscribe_repos_message(message)
-
-        if isinstance(parsed_message, models.ComAtprotoSyncSubscribeRepos.Account):
-            await nm.publish(
-                get_nats_subject("account"), EventAccount(kind="account", account=parsed_message.model_dump())
-            )
-            counters["account"].labels(parsed_message.active, parsed_message.status).inc()
-
-        if isinstance(parsed_message, models.ComAtprotoSyncSubscribeRepos.Identity):
-            await nm.publish(
-                get_nats_subject("identity"), EventIdentity(kind="identity", identity=parsed_message.model_dump())
-            )
-            counters["identity"].inc()
-
-        if not isinstance(parsed_message, models.ComAtprotoSyncSubscribeRepos.Commit):
-            return
-
-        if parsed_message.seq % _config.ENJOYER_CHECKPOINT == 0:
-            client.update_params(models.ComAtprotoSyncSubscribeRepos.Params(cursor=parsed_message.seq))
-            logger.debug(f"saving new cursor: {parsed_message.seq}")
-            await kv.put("cursor", str(parsed_message.seq).encode())
+    batcher = None
+    if _config.ENJOYER_BATCH_SIZE > 0:
+        batcher = BatchPublisher(
+            nm,
+            fmt=_config.ENJOYER_EVENT_FORMAT,
+            max_size=_config.ENJOYER_BATCH_SIZE,
+            max_delay=_config.ENJOYER_BATCH_DELAY_MS / 1000,
+        )
+        asyncio.create_task(batcher.run(stop_event))
+
+    def save_cursor(seq: int):
+        # reconnections resume from the last saved cursor
+        params["cursor"] = seq
+        logger.debug(f"saved new cursor: {seq}")
+
+    def on_publish_failed(count: int):
+        publish_errors.inc(count)
+        # the saved cursor is before the lost messages, they are read again from the firehose on restart
+        logger.error("Messages were not persisted after all retries, stopping")
+        stop_event.set()
+
+    checkpointer = None
+    if not args.replay:
+        checkpointer = Checkpointer(
+            kv,
+            cursor_key,
+            interval=_config.ENJOYER_CHECKPOINT_INTERVAL,
+            max_frames=_config.ENJOYER_CHECKPOINT,
+            on_save=save_cursor,
+            on_failed=on_publish_failed,
+        )
+        asyncio.create_task(checkpointer.run(stop_event))
+
+    async def publish(subject: str, event: Event, seq: int | None, index: int) -> asyncio.Future:
+        # the seq of the frame and the index of the event in it: a retried publish is dropped by JetStream if the
+        # first one was stored after all
+        msg_id = f"{seq}.{index}" if seq is not None else None
+        if batcher:
+            return await batcher.add(subject, event, seq, msg_id)
+        return await nm.publish_nowait(subject, encode_event(event, _config.ENJOYER_EVENT_FORMAT), msg_id)
+
+    async def on_message_handler(decoded: DecodedFrame) -> None:
+        counters["events"].inc()
+        if decoded["car_bytes"]:
+            counters["car_bytes"].inc(amount=decoded["car_bytes"])
+            counters["car_skipped_bytes"].inc(amount=decoded["car_skipped_bytes"])
+
+        acks = []
+        for index, event in enumerate(decoded["events"]):
+            if event["kind"] == "account":
+                subject = get_nats_subject("account", event["account"]["did"])
+                acks.append(await publish(subject, event, decoded["seq"], index))
+                counters["account"].inc(event["account"].get("active"), event["account"].get("status"))
+                continue
 
-        if not parsed_message.blocks:
-            return
+            if event["kind"] == "identity":
+                subject = get_nats_subject("identity", event["identity"]["did"])
+                acks.append(await publish(subject, event, decoded["seq"], index))
+                counters["identity"].inc()
+                continue
 
-        commits = _process_commit(parsed_message)
-        for commit in commits:
-            subject = get_nats_subject(commit["collection"])
+            commit = event["commit"]
+            subject = get_nats_subject(commit["collection"], commit["repo"])
 
             try:
-                await nm.publish(subject, EventCommit(kind="commit", commit=commit))
+                acks.append(await publish(subject, event, decoded["seq"], index))
             except Exception as e:
                 print(f"Error: {e}")
                 print(commit)
                 continue
 
-            counters["firehose"].labels(commit["operation"], commit["collection"]).inc()
+            counters["firehose"].inc(commit["operation"], commit["collection"])
 
             if commit["operation"] == "create" and commit["collection"] == models.ids.AppBskyFeedPost:
                 langs = commit["record"].get("langs", None)
@@ -133,70 +250,147 @@ async def subscribe_to_firehose(nm: NATSManager):
                     lang = langs[0][:2].lower() if len(langs) > 0 else "empty"
                 else:
                     lang = "none"
-                counters["post_langs"].labels(lang).inc()
+                counters["post_langs"].inc(lang)
+
+        # the cursor only moves once JetStream has acked everything published up to this frame
+        if checkpointer and decoded["seq"] is not None:
+            checkpointer.track(decoded["seq"], acks)
 
     cursor = await get_cursor()
     logger.info(f"Starting at cursor: {cursor}")
 
-    params = None
+    params = {}
     if cursor:
-        params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=cursor)
-    client.update_params(params)
-
-    await client.start(on_message_handler)
-
-
-def _process_commit(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> list[Commit]:
-    ops = []
-    car = CAR.from_bytes(commit.blocks)
-    for op in commit.ops:
-        uri = AtUri.from_str(f"at://{commit.repo}/{op.path}")
-
-        if uri.collection not in INTERESTED_RECORDS:
-            continue
-
-        if op.action in ["create", "update"]:
-            if not op.cid:
-                continue
+        params["cursor"] = cursor
+
+    if _config.ENJOYER_SOURCE == "jetstream":
+        # filtered by the server, so only interesting commits are ever sent
+        params["wantedCollections"] = list(INTERESTED_RECORDS)
+        dictionary_path = _config.ENJOYER_JETSTREAM_DICTIONARY
+        if dictionary_path:
+            # loaded now rather than on the first frame: without it every compressed frame would be dropped
+            try:
+                jetstream_decompressor(dictionary_path)
+                params["compress"] = "true"
+            except (OSError, zstandard.ZstdError) as e:
+                logger.warning(
+                    f"Cannot load the Jetstream dictionary {dictionary_path}, using uncompressed messages: {e}"
+                )
+                dictionary_path = ""
+        decode = functools.partial(decode_jetstream_frame, dictionary_path=dictionary_path)
+        uri = _config.ENJOYER_JETSTREAM_URI
+    else:
+        decode = decode_frame
+        uri = f"{_config.ENJOYER_FIREHOSE_URI}/com.atproto.sync.subscribeRepos"
+
+    if args.replay:
+        frames = replay_frames(args.replay, args.replay_speed)
+    else:
+        frames = websocket_frames(uri, params)
+    if args.capture:
+        frames = capture_frames(frames, args.capture)
+
+    handled = 0
+
+    async def handle_decoded(decoded: DecodedFrame) -> None:
+        nonlocal handled
+        handled += 1
+        try:
+            await on_message_handler(decoded)
+        except Exception as e:
+            logger.error(f"Error handling frame: {e}")
+
+    # the socket is read by its own task: a slow publish or kv.put only grows the queue, spooled to disk past
+    # ENJOYER_QUEUE_SIZE frames, instead of stalling the relay connection
+    queue = SpooledQueue(
+        maxsize=_config.ENJOYER_QUEUE_SIZE,
+        directory=_config.ENJOYER_SPOOL_DIR,
+        segment_size=_config.ENJOYER_SPOOL_SEGMENT_SIZE * 1024 * 1024,
+    )
+    queue_gauges["depth"].set_function(lambda: len(queue))
+    queue_gauges["spool_size"].set_function(lambda: queue.spool_size)
+    receiver = asyncio.create_task(receive_frames(frames, queue))
 
-            record_raw_data = car.blocks.get(op.cid)
-            if not record_raw_data:
+    if _config.ENJOYER_DECODE_WORKERS <= 0:
+        while not stop_event.is_set() and (frame := await queue.get()) is not None:
+            try:
+                decoded = decode(frame)
+            except Exception as e:
+                logger.error(f"Error decoding frame: {e}")
                 continue
-
-            ops.append(
-                {
-                    "operation": op.action,
-                    "repo": uri.host,
-                    "collection": uri.collection,
-                    "rkey": uri.rkey,
-                    "record": record_raw_data,
-                }
-            )
-
-        if op.action == "delete":
-            ops.append(
-                {
-                    "operation": op.action,
-                    "repo": uri.host,
-                    "collection": uri.collection,
-                    "rkey": uri.rkey,
-                }
-            )
-
-    return ops
+            await handle_decoded(decoded)
+    else:
+        # chunks are decoded out of order by the pool but handled in the order they were received,
+        # so the checkpointed cursor never gets ahead of a frame that was not published
+        loop = asyncio.get_running_loop()
+        chunk_size = max(_config.ENJOYER_DECODE_CHUNK, 1)
+        pending: asyncio.Queue[asyncio.Future] = asyncio.Queue(
+            maxsize=max(_config.ENJOYER_DECODE_QUEUE // chunk_size, 1)
+        )
+
+        async def handle_in_order():
+            while True:
+                future = await pending.get()
+                try:
+                    for decoded in await future:
+                        await handle_decoded(decoded)
+                except Exception as e:
+                    logger.error(f"Error decoding frames: {e}")
+                pending.task_done()
+
+        logger.info(f"Decoding frames with {_config.ENJOYER_DECODE_WORKERS} workers")
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=_config.ENJOYER_DECODE_WORKERS,
+            initializer=signal.signal,
+            initargs=(signal.SIGINT, signal.SIG_IGN),
+        ) as pool:
+            consumer = asyncio.create_task(handle_in_order())
+            while not stop_event.is_set() and (frame := await queue.get()) is not None:
+                # whatever is already queued goes along, a chunk never waits for more frames
+                chunk = [frame]
+                while len(chunk) < chunk_size and (frame := queue.get_nowait()) is not None:
+                    chunk.append(frame)
+                await pending.put(loop.run_in_executor(pool, decode_frames, chunk, decode))
+            await pending.join()
+            consumer.cancel()
+
+    await receiver
+
+    if batcher:
+        await batcher.flush()
+    if checkpointer:
+        await nm.flush()
+        await checkpointer.save()
+
+    return handled
 
 
 async def start_service():
     logger.info("Connecting to NATS and checking stuff")
     await nm.connect()
     await nm.create_stream(
-        prefixes=[_config.NATS_STREAM_SUBJECT_PREFIX],
+        prefixes=[_config.NATS_STREAM_SUBJECT_PREFIX, _config.NATS_STREAM_CBOR_SUBJECT_PREFIX],
         max_age=_config.NATS_STREAM_MAX_AGE,
         max_size=_config.NATS_STREAM_MAX_SIZE,
     )
 
-    logger.info("Starting firehose enjoyer")
-    await subscribe_to_firehose(nm)
+    logger.info(f"Starting {_config.ENJOYER_SOURCE} enjoyer")
+    started, cpu_started = time.monotonic(), _cpu_time()
+    frames = await subscribe_to_firehose(nm)
+
+    if args.replay:
+        failed = await nm.flush()
+        elapsed, cpu = time.monotonic() - started, _cpu_time() - cpu_started
+        logger.info(
+            f"Replayed {frames} frames in {elapsed:.1f}s: {frames / elapsed:.0f} frames/s, "
+            f"{1e6 * cpu / max(frames, 1):.0f} us cpu/frame ({failed} failed publishes)"
+        )
+
+
+def _cpu_time() -> float:
+    # children are the decode workers, counted once the pool has been shut down
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
 
 
 async def start_uvicorn() -> None:
@@ -211,6 +405,7 @@ async def main() -> None:
         [
             asyncio.create_task(start_uvicorn()),
             asyncio.create_task(start_service()),
+            asyncio.create_task(flush_counters()),
         ],
         return_when=asyncio.FIRST_COMPLETED,
     )
@@ -1,31 +1,79 @@
 import argparse
 import asyncio
+import concurrent.futures
+import dataclasses
 import datetime
-import json
 import signal
+import time
 from collections import defaultdict
 
-from atproto import AtUri, models
-from atproto_client.models.unknown_type import UnknownRecordType
+import uvicorn
+from atproto import models
 from nats.aio.msg import Msg
 from nats.js.api import AckPolicy, ConsumerConfig, DeliverPolicy
 from nats.js.errors import NotFoundError
-from pymongo import DeleteOne, IndexModel, InsertOne, UpdateOne
+from prometheus_client import Counter, Histogram, make_asgi_app
+from pymongo import DeleteOne, IndexModel, InsertOne
 from pymongo.errors import BulkWriteError
 
+from backend.batching import AdaptiveFetchPolicy, FetchPolicy, watch_consumer
+from backend.buffers import BufferedWriter, BufferPolicy
+from backend.compaction import compact, split_by_document
 from backend.config import Config
 from backend.database import MongoDBManager
 from backend.defaults import INTERACTION_RECORDS
+from backend.dids import DidInterner, compact_interaction_ops
+from backend.indexing import CreateDoc, DeleteDoc, TallyInc, parse_messages
 from backend.logger import Logger
-from backend.stream import NATSManager
-from backend.types import Commit, Event
+from backend.membership import PostFilter
+from backend.partitions import PartitionRouter, partition_day
+from backend.rebuild import RebuildWriter
+from backend.rollups import ROLLUP_INDEXES, rollup_collection, rollup_fields, rollup_incs
+from backend.stream import NATSManager, partition_consumer_config
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--log", default="INFO")
+parser.add_argument("--rebuild", action="store_true", help="rebuild the collections from the stream, then exit")
+parser.add_argument("--from-seq", type=int, help="first stream sequence to rebuild from")
+parser.add_argument("--from-time", type=datetime.datetime.fromisoformat, help="first message time to rebuild from")
 args = parser.parse_args()
 logger = Logger("indexer", level=args.log.upper())
 
 is_shutdown = False
+POST_TTL_DAYS = 8
+# every subject with something to index, the main consumer reads those not taken by a lane
+INDEXED_SUBJECTS = [
+    "account",
+    "identity",
+    models.ids.AppBskyActorProfile,
+    models.ids.AppBskyGraphBlock,
+    *INTERACTION_RECORDS,
+]
+app = make_asgi_app()
+
+# ops before and after the batch compaction, out/in is the reduction ratio
+compaction_ops = {
+    "in": Counter("indexer_compaction_ops_in", "db ops produced by parsing, before compaction"),
+    "out": Counter("indexer_compaction_ops_out", "db ops left after compaction"),
+}
+process_time = Histogram(
+    "indexer_process_seconds",
+    "time to parse a message into db ops",
+    buckets=(1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, float("inf")),
+)
+bulk_write_time = Histogram("indexer_bulk_write_seconds", "time of a bulk write", ["collection"])
+written_ops = Counter("indexer_ops", "db ops sent to mongo", ["collection", "op"])
+partition_dropped = Counter("indexer_partition_dropped", "ops of records outside the partitions", ["collection"])
+post_filter_checks = Counter("indexer_post_filter", "tally updates checked against the post filter", ["result"])
+write_errors = Counter("indexer_write_errors", "ops rejected by mongo, 11000 is duplicate key", ["collection", "code"])
+
+
+def _op_type(op) -> str:
+    if isinstance(op, InsertOne):
+        return "insert"
+    if isinstance(op, DeleteOne):
+        return "delete"
+    return "update"
 
 
 def signal_handler(signum, frame):
@@ -38,362 +86,739 @@ signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
 
-def _get_date(created_at: str | None = None):
-    if created_at:
-        dt = datetime.datetime.fromisoformat(created_at)
-    else:
-        dt = datetime.datetime.now(tz=datetime.timezone.utc)
-    return dt.replace(minute=0, second=0, microsecond=0)
-
-
-def _create_interaction(
-    created_at: str,
-    author: str,
-    rkey: str,
-    subject: str,
-    others: dict = {},
-):
-    if author == subject:
-        return None
+def get_interaction_collections(_config: Config) -> list[str]:
+    return [
+        "{}.{}".format(_config.INTERACTIONS_COLLECTION, record_type.split(".")[-1])
+        for record_type in INTERACTION_RECORDS
+    ]
+
 
-    return {
-        "_id": f"{author}/{rkey}",
-        "a": author,
-        "s": subject,
-        "t": _get_date(created_at),
-        **others,
+def get_collection_indexes(_config: Config) -> dict[str, list[IndexModel]]:
+    # the unpartitioned collections keep their TTL index: it empties them once partitioning is turned on
+    indexes = {
+        col: [
+            IndexModel(["a", "t"]),
+            IndexModel(["s", "t"]),
+            IndexModel("t", expireAfterSeconds=60 * 60 * 24 * 15),
+        ]
+        for col in get_interaction_collections(_config)
     }
+    indexes[models.ids.AppBskyGraphBlock] = [
+        IndexModel(["author", "created_at"]),
+        IndexModel(["subject", "created_at"]),
+    ]
+    indexes[models.ids.AppBskyFeedPost] = [
+        IndexModel("indexed_at", expireAfterSeconds=60 * 60 * 24 * POST_TTL_DAYS),
+    ]
+    return indexes
 
 
-def _parse_create_interaction(author: str, rkey: str, record: UnknownRecordType):
-    if models.is_record_type(record, models.ids.AppBskyFeedLike) or models.is_record_type(
-        record, models.ids.AppBskyFeedRepost
-    ):
-        return _create_interaction(
-            record.created_at,
-            author,
-            rkey,
-            AtUri.from_str(record.subject.uri).host,
-        )
+def get_partition_indexes(_config: Config) -> dict[str, list[IndexModel]]:
+    """Indexes of the partitions of each partitioned collection, which expire by being dropped."""
+    indexes = {col: [IndexModel(["a", "t"]), IndexModel(["s", "t"])] for col in get_interaction_collections(_config)}
+    indexes[models.ids.AppBskyFeedPost] = [IndexModel("indexed_at")]
+    return indexes
 
-    if models.is_record_type(record, models.ids.AppBskyFeedPost):
-        if record.reply is not None and record.reply.parent is not None:
-            return _create_interaction(
-                record.created_at,
-                author,
-                rkey,
-                AtUri.from_str(record.reply.parent.uri).host,
-                dict(c=len(record.text)),
-            )
 
-        if record.embed is not None:
-            if models.is_record_type(record.embed, models.ids.AppBskyEmbedRecord):
-                return _create_interaction(
-                    record.created_at,
-                    author,
-                    rkey,
-                    AtUri.from_str(record.embed.record.uri).host,
-                    dict(c=len(record.text)),
-                )
+def get_partition_router(_config: Config) -> PartitionRouter | None:
+    if not _config.INTERACTIONS_PARTITIONED:
+        return None
+    return PartitionRouter(
+        {
+            **{col: _config.INTERACTIONS_RETENTION_DAYS for col in get_interaction_collections(_config)},
+            models.ids.AppBskyFeedPost: POST_TTL_DAYS,
+        }
+    )
 
-            if models.is_record_type(record.embed, models.ids.AppBskyEmbedRecordWithMedia):
-                if models.is_record_type(record.embed.record, models.ids.AppBskyEmbedRecord):
-                    return _create_interaction(
-                        record.created_at,
-                        author,
-                        rkey,
-                        AtUri.from_str(record.embed.record.record.uri).host,
-                        dict(c=len(record.text)),
-                    )
-
-
-def _parse_interaction(commit: Commit) -> InsertOne | DeleteOne | None:
-    if commit["operation"] == "create":
-        record = models.get_or_create(commit["record"], strict=False)
-        interaction = _parse_create_interaction(commit["repo"], commit["rkey"], record)
-        if interaction:
-            return InsertOne(interaction)
-    elif commit["operation"] == "delete":
-        return DeleteOne({"_id": "{}/{}".format(commit["repo"], commit["rkey"])})
-
-
-def _parse_profile(commit: Commit) -> UpdateOne:
-    if commit["operation"] == "create" or commit["operation"] == "update":
-        record = models.get_or_create(commit["record"], strict=False)
-        return UpdateOne(
-            {"_id": commit["repo"]},
-            {
-                "$set": {
-                    **record.model_dump(exclude=["avatar", "banner", "py_type"]),
-                    "created_at": (
-                        datetime.datetime.fromisoformat(record["created_at"]) if record["created_at"] else None
-                    ),
-                    "updated_at": datetime.datetime.now(tz=datetime.timezone.utc),
-                },
-                "$setOnInsert": {
-                    "indexed_at": datetime.datetime.now(tz=datetime.timezone.utc),
-                },
-            },
-            upsert=True,
-        )
-    elif commit["operation"] == "delete":
-        return UpdateOne(
-            {"_id": commit["repo"]},
-            {"$set": {"deleted": True}},
-            upsert=True,
-        )
+
+def get_filter_subjects(_config: Config) -> list[str]:
+    if _config.INDEXER_FILTER_SUBJECTS:
+        return _config.INDEXER_FILTER_SUBJECTS
+    # both payload formats are consumed during a migration from json to cbor
+    prefixes = [_config.NATS_STREAM_SUBJECT_PREFIX, _config.NATS_STREAM_CBOR_SUBJECT_PREFIX]
+    if not _config.INDEXER_LANES and not _config.NATS_STREAM_SHARDS:
+        return [f"{prefix}.>" for prefix in prefixes]
+    laned = {subject for lane in _config.INDEXER_LANES.values() for subject in lane["subjects"]}
+    return [
+        f"{prefix}.{subject}"
+        for prefix in prefixes
+        for subject in INDEXED_SUBJECTS
+        if f"{prefix}.{subject}" not in laned
+    ]
+
+
+def get_consumer_config(_config: Config, **kwargs) -> ConsumerConfig:
+    return ConsumerConfig(
+        **{
+            "name": _config.INDEXER_CONSUMER,
+            "durable_name": _config.INDEXER_CONSUMER,
+            "filter_subjects": get_filter_subjects(_config),
+            "deliver_policy": DeliverPolicy.ALL,
+            "ack_policy": AckPolicy.EXPLICIT if _config.INDEXER_SHARED_CONSUMER else AckPolicy.ALL,
+            "ack_wait": 60,
+            "max_ack_pending": -1,
+            **kwargs,
+        }
+    )
 
 
-def _parse_block(commit: Commit) -> InsertOne | DeleteOne | None:
-    _id = "{}/{}/{}".format(commit["repo"], commit["collection"], commit["rkey"])
-    if commit["operation"] == "create":
-        record = models.get_or_create(commit["record"], strict=False)
-        return InsertOne(
-            {
-                "_id": _id,
-                "author": commit["repo"],
-                "subject": record.subject,
-                "created_at": datetime.datetime.fromisoformat(record.created_at),
-            }
+def get_lane_configs(_config: Config) -> list[tuple[ConsumerConfig, int, int]]:
+    """(consumer config, batch size, concurrency) of every lane."""
+    lanes = []
+    for lane, options in _config.INDEXER_LANES.items():
+        concurrency = options.get("concurrency", 1)
+        explicit = _config.INDEXER_SHARED_CONSUMER
+        consumer_config = get_consumer_config(
+            _config,
+            name=f"{_config.INDEXER_CONSUMER}-{lane}",
+            durable_name=f"{_config.INDEXER_CONSUMER}-{lane}",
+            filter_subjects=options["subjects"],
+            ack_policy=AckPolicy.EXPLICIT if explicit else AckPolicy.ALL,
         )
-    elif commit["operation"] == "delete":
-        return DeleteOne({"_id": _id})
-
-
-def update_and_inc(repo: str, target_uri: str, field: str):
-    full_field = f"tally.self_{field}" if repo in target_uri else f"tally.{field}"
-    return UpdateOne({"_id": target_uri}, {"$inc": {full_field: 1}})
-
-
-def _parse_tally(commit: Commit) -> list[InsertOne | UpdateOne | DeleteOne]:
-    ops = []
-
-    operation = commit["operation"]
-    repo = commit["repo"]
-    collection = commit["collection"]
-    rkey = commit["rkey"]
-    uri = AtUri.from_str("at://{}/{}/{}".format(repo, collection, rkey))
-
-    if operation == "delete" and collection == models.ids.AppBskyFeedPost:
-        ops.append(DeleteOne({"_id": str(uri)}))
-
-    if operation == "create":
-        record = models.get_or_create(commit["record"], strict=False)
-        if record is None:
-            return []
-
-        if collection == models.ids.AppBskyFeedPost:
-            ops.append(
-                InsertOne(
-                    {
-                        "_id": str(uri),
-                        "author": repo,
-                        "created_at": datetime.datetime.fromisoformat(record.created_at),
-                        "indexed_at": datetime.datetime.now(tz=datetime.timezone.utc),
-                        "langs": commit["record"].get("langs", None),
-                        "reply": commit["record"].get("reply", None),
-                    }
-                )
-            )
-
-            if record.reply:
-                if record.reply.parent:
-                    ops.append(update_and_inc(repo, str(record.reply.parent.uri), "replies"))
-                if record.reply.root:
-                    ops.append(update_and_inc(repo, str(record.reply.root.uri), "root_replies"))
+        lanes.append((consumer_config, options.get("batch_size", _config.INDEXER_BATCH_SIZE), concurrency))
+    return lanes
 
-            if record.embed:
-                target_uri = None
-                if models.is_record_type(record.embed, models.ids.AppBskyEmbedRecord):
-                    target_uri = str(record.embed.record.uri)
-                if models.is_record_type(
-                    record.embed, models.ids.AppBskyEmbedRecordWithMedia
-                ) and models.is_record_type(record.embed.record, models.ids.AppBskyEmbedRecord):
-                    target_uri = str(record.embed.record.record.uri)
 
-                if target_uri:
-                    ops.append(update_and_inc(repo, target_uri, "quotes"))
+async def ensure_consumer(js, stream: str, consumer_config: ConsumerConfig, start_after: str | None = None) -> bool:
+    """Creates the consumer or updates its subjects, False if it exists with another ack policy.
 
-        if collection == models.ids.AppBskyFeedLike:
-            ops.append(update_and_inc(repo, str(record.subject.uri), "likes"))
+    Created with `start_after`, it starts after the ack floor of that consumer instead of at the first message: a
+    new lane does not read again what the main consumer indexed when it was reading the lane's subjects.
+    """
+    consumer = consumer_config.durable_name
+    try:
+        info = await js.consumer_info(stream, consumer)
+        if info.config.ack_policy != consumer_config.ack_policy:
+            # JetStream does not allow changing the ack policy of a consumer
+            logger.error(
+                f"Consumer {consumer} acks {info.config.ack_policy}, not {consumer_config.ack_policy}: "
+                "delete it or use another name"
+            )
+            return False
+        if info.config.filter_subjects != consumer_config.filter_subjects:
+            logger.info(f"Updating consumer {consumer} subjects to {consumer_config.filter_subjects}")
+            # where a consumer starts cannot be updated either
+            consumer_config = dataclasses.replace(
+                consumer_config,
+                deliver_policy=info.config.deliver_policy,
+                opt_start_seq=info.config.opt_start_seq,
+            )
+            await js.add_consumer(stream=stream, config=consumer_config)
+    except NotFoundError:
+        if start_after:
+            start = (await js.consumer_info(stream, start_after)).ack_floor.stream_seq + 1
+            logger.info(f"Creating consumer {consumer} from message {start}, {start_after} acked what is before")
+            consumer_config = dataclasses.replace(
+                consumer_config, deliver_policy=DeliverPolicy.BY_START_SEQUENCE, opt_start_seq=start
+            )
+        await js.add_consumer(stream=stream, config=consumer_config)
+    return True
+
+
+async def parse_batch(
+    msgs: list[Msg], _config: Config, pool: concurrent.futures.ProcessPoolExecutor | None
+) -> dict[str, list]:
+    messages = [(msg.subject, msg.data) for msg in msgs]
+    parse_args = (_config.NATS_STREAM_CBOR_SUBJECT_PREFIX, _config.INTERACTIONS_COLLECTION)
+    if pool is None:
+        all_ops, durations = parse_messages(messages, *parse_args)
+        for duration in durations:
+            process_time.observe(duration)
+        return all_ops
+
+    # one chunk per worker, only the merged op lists come back
+    loop = asyncio.get_running_loop()
+    chunk_size = -(-len(messages) // _config.INDEXER_PARSE_WORKERS)
+    chunks = await asyncio.gather(
+        *[
+            loop.run_in_executor(pool, parse_messages, messages[i : i + chunk_size], *parse_args)
+            for i in range(0, len(messages), chunk_size)
+        ]
+    )
+    all_ops = defaultdict(list)
+    for db_ops, durations in chunks:
+        for col, ops in db_ops.items():
+            all_ops[col].extend(ops)
+        for duration in durations:
+            process_time.observe(duration)
+    return all_ops
 
-        if collection == models.ids.AppBskyFeedRepost:
-            ops.append(update_and_inc(repo, str(record.subject.uri), "reposts"))
 
-    return ops
+def get_parse_pool(_config: Config) -> concurrent.futures.ProcessPoolExecutor | None:
+    if _config.INDEXER_PARSE_WORKERS <= 0:
+        return None
+    logger.info(f"Parsing messages with {_config.INDEXER_PARSE_WORKERS} workers")
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=_config.INDEXER_PARSE_WORKERS,
+        initializer=signal.signal,
+        initargs=(signal.SIGINT, signal.SIG_IGN),
+    )
 
 
 async def main():
     _config = Config()
+    if _config.INDEXER_LANES and _config.INDEXER_FILTER_SUBJECTS:
+        # the main consumer would read the lanes' subjects too
+        logger.error("INDEXER_FILTER_SUBJECTS cannot be used with INDEXER_LANES")
+        return
+
     nats_manager = NATSManager(uri=_config.NATS_URI, stream=_config.NATS_STREAM)
     mongo_manager = MongoDBManager(uri=_config.MONGO_URI)
 
-    async def _process_data(data: str):
-        event: Event = json.loads(data)
-        db_ops = defaultdict(list)
-
-        if not _config.INDEXER_ENABLE:
-            return db_ops
-
-        if event["kind"] == "account":
-            account = models.ComAtprotoSyncSubscribeRepos.Account.model_validate(event["account"], strict=False)
-            db_ops[models.ids.AppBskyActorProfile].append(
-                UpdateOne(
-                    {"_id": account.did},
-                    {
-                        "$set": {
-                            "active": account.active,
-                            "status": account.status,
-                            "updated_at": datetime.datetime.now(tz=datetime.timezone.utc),
-                        },
-                        "$setOnInsert": {
-                            "indexed_at": datetime.datetime.now(tz=datetime.timezone.utc),
-                        },
-                    },
-                    upsert=True,
-                )
-            )
+    logger.info("Connecting to Mongo")
+    await mongo_manager.connect()
+    db = mongo_manager.client.get_database(_config.INDEXER_DB)
 
-        if event["kind"] == "identity":
-            identity = models.ComAtprotoSyncSubscribeRepos.Identity.model_validate(event["identity"], strict=False)
-            db_ops[models.ids.AppBskyActorProfile].append(
-                UpdateOne(
-                    {"_id": identity.did},
-                    {
-                        "$set": {
-                            "handle": identity.handle,
-                            "updated_at": datetime.datetime.now(tz=datetime.timezone.utc),
-                        },
-                        "$setOnInsert": {
-                            "indexed_at": datetime.datetime.now(tz=datetime.timezone.utc),
-                        },
-                    },
-                    upsert=True,
-                )
+    interaction_collections = get_interaction_collections(_config)
+    for col, indexes in get_collection_indexes(_config).items():
+        await db[col].create_indexes(indexes)
+
+    rollups = {}
+    if _config.INDEXER_ROLLUPS:
+        rollups = rollup_fields(_config.INTERACTIONS_COLLECTION)
+        await db[rollup_collection(_config.INTERACTIONS_COLLECTION)].create_indexes(ROLLUP_INDEXES)
+
+    interner = None
+    if _config.INTERACTIONS_COMPACT_DIDS:
+        interner = DidInterner(db, _config.DIDS_CACHE_SIZE)
+        await interner.create_indexes()
+
+    partition_indexes = get_partition_indexes(_config)
+    router = get_partition_router(_config)
+    if router is not None:
+        router.add_known(await db.list_collection_names())
+
+    post_filter = None
+    if _config.INDEXER_POST_FILTER:
+        if _config.INDEXER_SHARED_CONSUMER or _config.INDEXER_FILTER_SUBJECTS or _config.NATS_STREAM_SHARDS:
+            logger.error(
+                "The post filter needs every post create, not using it with a shared, filtered or sharded consumer"
             )
+        else:
+            post_collections = [models.ids.AppBskyFeedPost]
+            if router is not None:
+                post_collections += [
+                    name for name in await db.list_collection_names() if partition_day(models.ids.AppBskyFeedPost, name)
+                ]
+            post_filter = await load_post_filter(db, post_collections, _config)
+
+    # the consumer configs of every shard, then of the one read here
+    consumer_templates = [get_consumer_config(_config)] + [lane[0] for lane in get_lane_configs(_config)]
+    consumer_configs, lanes = consumer_templates[:1], get_lane_configs(_config)
+    if _config.NATS_STREAM_SHARDS:
+        consumer_configs = [partition_consumer_config(consumer_templates[0], _config.INDEXER_SHARD)]
+        lanes = [(partition_consumer_config(config, _config.INDEXER_SHARD), *rest) for config, *rest in lanes]
+    consumer = consumer_configs[0].durable_name
 
-        if event["kind"] == "commit":
-            commit = event["commit"]
-            collection = commit["collection"]
+    logger.info("Connecting to NATS")
+    await nats_manager.connect()
 
-            if collection == models.ids.AppBskyActorProfile:
-                profile_op = _parse_profile(commit)
-                if profile_op:
-                    db_ops[collection].append(profile_op)
+    stop_event = asyncio.Event()
+    adaptive_policy = None
+    if _config.INDEXER_ADAPTIVE_BATCH:
+        adaptive_policy = AdaptiveFetchPolicy(
+            nats_manager.js,
+            _config.NATS_STREAM,
+            consumer,
+            batch_size=_config.INDEXER_BATCH_SIZE,
+            min_batch=_config.INDEXER_BATCH_SIZE_MIN,
+            max_batch=_config.INDEXER_BATCH_SIZE_MAX,
+            min_interval=0.0,
+            max_interval=_config.INDEXER_FLUSH_INTERVAL_MAX_MS / 1000,
+            target_latency=_config.INDEXER_TARGET_WRITE_MS / 1000,
+        )
 
-            if collection == models.ids.AppBskyGraphBlock:
-                block_op = _parse_block(commit)
-                if block_op:
-                    db_ops[collection].append(block_op)
+    logger.info("Starting service")
 
-            if collection in INTERACTION_RECORDS:
-                tally_ops = _parse_tally(commit)
-                if len(tally_ops) > 0:
-                    db_ops[models.ids.AppBskyFeedPost].extend(tally_ops)
+    async def bulk_write(col: str, ops: list, target: str | None = None) -> set[int]:
+        """Writes the ops unordered to `target` (default `col`), returns the indexes of the duplicate key ones.
 
-                interaction_op = _parse_interaction(commit)
-                if interaction_op:
-                    coll_name = "{}.{}".format(_config.INTERACTIONS_COLLECTION, collection.split(".")[-1])
-                    db_ops[coll_name].append(interaction_op)
+        Any other error is raised, so the messages of the ops are not acked.
+        """
+        duplicates = set()
+        op_types = defaultdict(int)
+        for op in ops:
+            op_types[_op_type(op)] += 1
+        for op_type, count in op_types.items():
+            written_ops.labels(col, op_type).inc(count)
 
-        return db_ops
+        started = time.monotonic()
+        try:
+            await db[target or col].bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            codes = defaultdict(int)
+            for error in e.details.get("writeErrors", []):
+                codes[error.get("code")] += 1
+                duplicates.add(error["index"])
+            for code, count in codes.items():
+                write_errors.labels(col, str(code)).inc(count)
+            # a write concern error leaves no write error, it is not a duplicate either
+            if set(codes) - {11000} or e.details.get("writeConcernErrors"):
+                logger.error(f"Error writing to {col}: {dict(codes)}")
+                raise
+            logger.error(f"Error writing to {col}: duplicate keys")
+        except Exception as e:
+            logger.error(f"Error writing to {col}: {e}")
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            bulk_write_time.labels(col).observe(elapsed)
+            if adaptive_policy:
+                adaptive_policy.observe_write(col, elapsed)
+        return duplicates
+
+    def filter_tallies(ops: list) -> list:
+        # posts of this batch are added first: a tally update can target a post created in the same batch
+        for op in ops:
+            if isinstance(op, CreateDoc):
+                post_filter.add(op.key, op.document["indexed_at"])
+
+        kept = []
+        absent = 0
+        for op in ops:
+            if isinstance(op, TallyInc) and op.target not in post_filter:
+                absent += 1
+                continue
+            kept.append(op)
+        post_filter_checks.labels("absent").inc(absent)
+        post_filter_checks.labels("maybe").inc(sum(isinstance(op, TallyInc) for op in kept))
+        return kept
+
+    async def write_collection(col: str, ops: list):
+        if post_filter is not None and col == models.ids.AppBskyFeedPost:
+            ops = filter_tallies(ops)
+            if not ops:
+                return
+
+        if router is not None and col in router.retention:
+            routed, dropped = router.route(col, ops)
+            partition_dropped.labels(col).inc(dropped)
+            for name in routed:
+                day = partition_day(col, name)
+                if day not in router.known[col]:
+                    logger.info(f"Creating partition {name}")
+                    await db[name].create_indexes(partition_indexes[col])
+                    router.known[col].add(day)
+            await asyncio.gather(*[write_records(col, name, ops) for name, ops in routed.items()])
+            return
 
-    logger.info("Connecting to Mongo")
-    await mongo_manager.connect()
-    db = mongo_manager.client.get_database(_config.INDEXER_DB)
+        await write_records(col, col, ops)
 
-    for record_type in INTERACTION_RECORDS:
-        doc_collection = "{}.{}".format(_config.INTERACTIONS_COLLECTION, record_type.split(".")[-1])
-        await db[doc_collection].create_indexes(
-            [
-                IndexModel(["a", "t"]),
-                IndexModel(["s", "t"]),
-                IndexModel("t", expireAfterSeconds=60 * 60 * 24 * 15),
-            ]
-        )
+    async def write_records(col: str, target: str, ops: list):
+        if interner is not None and col in interaction_collections:
+            ops = await compact_interaction_ops(interner, ops)
+            if not ops:
+                return
 
-    await db[models.ids.AppBskyGraphBlock].create_indexes(
-        [
-            IndexModel(["author", "created_at"]),
-            IndexModel(["subject", "created_at"]),
-        ]
-    )
+        field = rollups.get(col)
+        if field is None:
+            await bulk_write(col, ops, target)
+            return
 
-    await db[models.ids.AppBskyFeedPost].create_indexes(
-        [
-            IndexModel("indexed_at", expireAfterSeconds=60 * 60 * 24 * 8),
-        ]
-    )
+        # deletes only carry the `_id`: what they count out of the rollups is read before they run
+        deleted_keys = [op.key for op in ops if isinstance(op, DeleteDoc)]
+        deleted = {}
+        if deleted_keys:
+            async for doc in db[target].find({"_id": {"$in": deleted_keys}}, {"a": 1, "s": 1, "t": 1, "c": 1}):
+                deleted[doc["_id"]] = doc
+
+        duplicates = await bulk_write(col, ops, target)
+        written = [op for idx, op in enumerate(ops) if idx not in duplicates]
+        rollup_ops = rollup_incs(
+            field,
+            [op.document for op in written if isinstance(op, CreateDoc)],
+            [deleted[op.key] for op in written if isinstance(op, DeleteDoc) and op.key in deleted],
+        )
+        if rollup_ops:
+            await bulk_write(rollup_collection(_config.INTERACTIONS_COLLECTION), rollup_ops)
+
+    pool = get_parse_pool(_config)
+
+    def compact_ops(all_ops: dict[str, list]) -> dict[str, list]:
+        # likes undone within the batch, repeated profile updates and many tally updates of a popular post all
+        # end up as a single op
+        ops_in = sum(len(ops) for ops in all_ops.values())
+        all_ops = compact(all_ops)
+        ops_out = sum(len(ops) for ops in all_ops.values())
+        compaction_ops["in"].inc(ops_in)
+        compaction_ops["out"].inc(ops_out)
+        logger.debug(f"compacted {ops_in} ops into {ops_out}")
+        return all_ops
+
+    async def ack_messages(msgs: list[Msg]):
+        if _config.INDEXER_SHARED_CONSUMER:
+            # other indexers get the messages in between, so acking the last one would ack theirs too
+            await asyncio.gather(*[msg.ack() for msg in msgs])
+        else:
+            await msgs[-1].ack()
+
+    async def nak_messages(msgs: list[Msg]):
+        await asyncio.gather(*[msg.nak() for msg in msgs])
+
+    async def flush_buffer(col: str, ops: list):
+        # a buffer holds several batches, compacting it as a whole merges more ops
+        for target, target_ops in compact_ops({col: ops}).items():
+            await write_collection(target, target_ops)
+
+    writer = None
+    if _config.INDEXER_BUFFERED_WRITES:
+        writer = BufferedWriter(
+            write=flush_buffer,
+            ack=ack_messages,
+            default_policy=BufferPolicy(
+                _config.INDEXER_BUFFER_MAX_OPS,
+                _config.INDEXER_BUFFER_MAX_AGE_MS / 1000,
+                _config.INDEXER_BUFFER_CONCURRENCY,
+            ),
+            policies={
+                col: BufferPolicy(
+                    policy.get("max_ops", _config.INDEXER_BUFFER_MAX_OPS),
+                    policy.get("max_age_ms", _config.INDEXER_BUFFER_MAX_AGE_MS) / 1000,
+                    policy.get("concurrency", _config.INDEXER_BUFFER_CONCURRENCY),
+                )
+                for col, policy in _config.INDEXER_BUFFER_POLICIES.items()
+            },
+            max_batches=_config.INDEXER_BUFFER_MAX_BATCHES,
+            nak=nak_messages if _config.INDEXER_SHARED_CONSUMER else None,
+        )
+        asyncio.create_task(writer.run(stop_event))
 
-    logger.info("Connecting to NATS")
-    await nats_manager.connect()
+    async def prepare_messages(msgs: list[Msg]) -> dict[str, list]:
+        logger.debug("received messages")
+        all_ops = await parse_batch(msgs, _config, pool) if _config.INDEXER_ENABLE else {}
+        logger.debug("done processing messages")
+        return all_ops if writer else compact_ops(all_ops)
 
-    logger.info("Starting service")
+    async def write_messages(msgs: list[Msg], all_ops: dict[str, list]):
+        if writer:
+            # acked by the writer once every buffer holding ops of these messages is flushed
+            await writer.add(msgs, all_ops)
+            return
 
-    async def bulk_write(col: str, ops: list):
-        try:
-            await db[col].bulk_write(ops, ordered=False)
-        except BulkWriteError:
-            logger.error(f"Error writing to {col}: duplicate keys")
-        except Exception as e:
-            logger.error(f"Error writing to {col}: {e}")
+        await asyncio.gather(*[write_collection(col, ops) for col, ops in all_ops.items()])
+        logger.debug("done writing in db")
+        await ack_messages(msgs)
 
     async def process_messages(msgs: list[Msg]):
         if not msgs:
             return
+        await write_messages(msgs, await prepare_messages(msgs))
+
+    def process_lane(explicit_ack: bool, concurrency: int):
+        # lanes are small: parsed on the event loop and written right away, without buffering. Batches are fetched
+        # and written one after the other, only the ops of different documents are written in parallel
+        async def process(msgs: list[Msg]):
+            all_ops = compact_ops(await parse_batch(msgs, _config, None)) if _config.INDEXER_ENABLE else {}
+            await asyncio.gather(
+                *[
+                    write_collection(col, group)
+                    for col, ops in all_ops.items()
+                    for group in split_by_document(ops, max(concurrency, 1))
+                    if group
+                ]
+            )
+            if explicit_ack:
+                await asyncio.gather(*[msg.ack() for msg in msgs])
+            else:
+                await msgs[-1].ack()
 
-        logger.debug("received messages")
-        all_ops = defaultdict(list)
-        for msg in msgs:
-            try:
-                db_ops = await _process_data(msg.data.decode())
-            except Exception as e:
-                db_ops = None
-                logger.error(f"Error processing message: {e}; msg={msg.data.decode()}")
-                continue
+        return process
 
-            if db_ops:
-                for col, ops in db_ops.items():
-                    all_ops[col].extend(ops)
-        logger.debug("done processing messages")
+    # the main consumer first, the lanes start after what it acked
+    for consumer_config in consumer_configs:
+        if not await ensure_consumer(nats_manager.js, _config.NATS_STREAM, consumer_config):
+            return
+    for consumer_config, *_ in lanes:
+        if not await ensure_consumer(nats_manager.js, _config.NATS_STREAM, consumer_config, start_after=consumer):
+            return
+    if _config.NATS_STREAM_SHARDS:
+        # the consumers of the other shards are created too, their messages are kept until an indexer claims them
+        await nats_manager.add_partition_consumers(
+            _config.NATS_STREAM, consumer_templates[0], _config.NATS_STREAM_SHARDS
+        )
+        for partition in range(_config.NATS_STREAM_SHARDS):
+            partition_consumer = partition_consumer_config(consumer_templates[0], partition).durable_name
+            for consumer_config in consumer_templates[1:]:
+                await ensure_consumer(
+                    nats_manager.js,
+                    _config.NATS_STREAM,
+                    partition_consumer_config(consumer_config, partition),
+                    start_after=partition_consumer,
+                )
+        logger.info(f"Reading shard {_config.INDEXER_SHARD} of {_config.NATS_STREAM_SHARDS}")
 
-        await asyncio.gather(*[bulk_write(col, ops) for col, ops in all_ops.items()])
-        logger.debug("done writing in db")
-        await msg.ack()
+    fetch_policy = FetchPolicy(_config.INDEXER_BATCH_SIZE)
+    if adaptive_policy:
+        fetch_policy = adaptive_policy
+        asyncio.create_task(adaptive_policy.run(stop_event))
+    else:
+        asyncio.create_task(watch_consumer(nats_manager.js, _config.NATS_STREAM, consumer, stop_event))
 
-    try:
-        await nats_manager.js.consumer_info(_config.NATS_STREAM, _config.INDEXER_CONSUMER)
-    except NotFoundError:
-        await nats_manager.js.add_consumer(
+    for consumer_config, batch_size, concurrency in lanes:
+        logger.info(f"Lane {consumer_config.durable_name}: {consumer_config.filter_subjects}")
+        asyncio.create_task(
+            watch_consumer(nats_manager.js, _config.NATS_STREAM, consumer_config.durable_name, stop_event)
+        )
+        await nats_manager.pull_subscribe(
             stream=_config.NATS_STREAM,
-            config=ConsumerConfig(
-                name=_config.INDEXER_CONSUMER,
-                durable_name=_config.INDEXER_CONSUMER,
-                filter_subject=f"{_config.NATS_STREAM_SUBJECT_PREFIX}.>",
-                deliver_policy=DeliverPolicy.ALL,
-                ack_policy=AckPolicy.ALL,
-                ack_wait=60,
-                max_ack_pending=-1,
-            ),
+            consumer=consumer_config.durable_name,
+            callback=process_lane(consumer_config.ack_policy == AckPolicy.EXPLICIT, concurrency),
+            batch_size=batch_size,
+            on_failed=stop_event.set,
         )
 
-    await nats_manager.pull_subscribe(
-        stream=_config.NATS_STREAM,
-        consumer=_config.INDEXER_CONSUMER,
-        callback=process_messages,
-        batch_size=_config.INDEXER_BATCH_SIZE,
-    )
+    if router is not None:
+        asyncio.create_task(expire_partitions(db, router, stop_event))
+
+    if post_filter is not None and _config.INDEXER_POST_FILTER_SNAPSHOT:
+        asyncio.create_task(save_post_filter(post_filter, _config, stop_event))
+
+    if _config.INDEXER_PIPELINE_DEPTH > 1:
+        # the next batches are fetched and parsed while mongo writes the current one
+        logger.info(f"Pipelining up to {_config.INDEXER_PIPELINE_DEPTH} batches")
+        await nats_manager.pull_subscribe_pipelined(
+            stream=_config.NATS_STREAM,
+            consumer=consumer,
+            prepare=prepare_messages,
+            write=write_messages,
+            batch_size=fetch_policy,
+            depth=_config.INDEXER_PIPELINE_DEPTH,
+            on_failed=stop_event.set,
+        )
+    else:
+        await nats_manager.pull_subscribe(
+            stream=_config.NATS_STREAM,
+            consumer=consumer,
+            callback=process_messages,
+            batch_size=fetch_policy,
+            on_failed=stop_event.set,
+        )
 
     try:
         while not is_shutdown:
+            if (writer and writer.failed) or stop_event.is_set():
+                logger.error("Stopping after a failed write, the messages not acked are redelivered on restart")
+                break
             await asyncio.sleep(1)
     except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("Shutting down...")
     finally:
+        stop_event.set()
+        if writer:
+            await writer.close()
+        if post_filter is not None and _config.INDEXER_POST_FILTER_SNAPSHOT:
+            post_filter.save(_config.INDEXER_POST_FILTER_SNAPSHOT, time.time())
         await nats_manager.disconnect()
         await mongo_manager.disconnect()
+        if pool is not None:
+            pool.shutdown()
         logger.info("Shutdown complete.")
 
 
+async def rebuild():
+    """Replays the stream into fresh copies of the interaction collections and swaps them in.
+
+    The indexer must be stopped meanwhile: writes it makes to the collections being rebuilt would be lost in the
+    swap. Its durable consumer is left as it is, once restarted it redelivers what it had not acked and the
+    interactions that are there already are rejected as duplicates.
+    """
+    _config = Config()
+    nats_manager = NATSManager(uri=_config.NATS_URI, stream=_config.NATS_STREAM)
+    mongo_manager = MongoDBManager(uri=_config.MONGO_URI)
+
+    logger.info("Connecting to Mongo")
+    await mongo_manager.connect()
+    db = mongo_manager.client.get_database(_config.INDEXER_DB)
+    logger.info("Connecting to NATS")
+    await nats_manager.connect()
+    js = nats_manager.js
+
+    interaction_collections = get_interaction_collections(_config)
+    collection_indexes = get_collection_indexes(_config)
+    partition_indexes = get_partition_indexes(_config)
+    router = get_partition_router(_config)
+    interner = None
+    if _config.INTERACTIONS_COMPACT_DIDS:
+        interner = DidInterner(db, _config.DIDS_CACHE_SIZE)
+        await interner.create_indexes()
+
+    # messages published after this one are left to the indexer
+    last_seq = (await js.stream_info(_config.NATS_STREAM)).state.last_seq
+    consumer = f"{_config.INDEXER_CONSUMER}-rebuild"
+    deliver = {"deliver_policy": DeliverPolicy.ALL}
+    if args.from_seq:
+        deliver = {"deliver_policy": DeliverPolicy.BY_START_SEQUENCE, "opt_start_seq": args.from_seq}
+    elif args.from_time:
+        start = args.from_time.astimezone(datetime.timezone.utc)
+        deliver = {"deliver_policy": DeliverPolicy.BY_START_TIME, "opt_start_time": start.isoformat()}
+    # ephemeral and unacked: it is only read once and goes away by itself if the rebuild dies
+    await js.add_consumer(
+        stream=_config.NATS_STREAM,
+        config=ConsumerConfig(
+            name=consumer,
+            # every shard, and the unsharded subjects of what was published before sharding
+            filter_subjects=[
+                subject
+                for prefix in (_config.NATS_STREAM_SUBJECT_PREFIX, _config.NATS_STREAM_CBOR_SUBJECT_PREFIX)
+                for record_type in INTERACTION_RECORDS
+                for subject in (f"{prefix}.{record_type}", f"{prefix}.{record_type}.*")
+            ],
+            ack_policy=AckPolicy.NONE,
+            inactive_threshold=300,
+            **deliver,
+        ),
+    )
+    psub = await js.pull_subscribe_bind(consumer=consumer, stream=_config.NATS_STREAM)
+
+    writer = RebuildWriter(db)
+    await writer.clear()
+    pool = get_parse_pool(_config)
+
+    async def write(all_ops: dict[str, list]):
+        for col, ops in all_ops.items():
+            if router is not None:
+                routed, dropped = router.route(col, ops)
+                partition_dropped.labels(col).inc(dropped)
+                for name in routed:
+                    router.known[col].add(partition_day(col, name))
+            else:
+                routed = {col: ops}
+            for target, ops in routed.items():
+                if interner is not None:
+                    ops = await compact_interaction_ops(interner, ops)
+                await writer.write(target, ops)
+
+    def indexes_for(target: str) -> list[IndexModel]:
+        for col in interaction_collections:
+            if target == col:
+                return collection_indexes[col]
+            if partition_day(col, target):
+                return partition_indexes[col]
+        return []
+
+    logger.info(f"Rebuilding {', '.join(interaction_collections)} up to message {last_seq}")
+    started = logged = time.monotonic()
+    count = 0
+    pending_write = None
+    first_time = None
+    done = False
+    try:
+        while not done and not is_shutdown:
+            try:
+                msgs = await psub.fetch(_config.INDEXER_BATCH_SIZE_MAX, timeout=5)
+            except TimeoutError:
+                msgs = []
+            if not msgs:
+                if (await js.consumer_info(_config.NATS_STREAM, consumer)).num_pending == 0:
+                    break
+                continue
+
+            kept = [msg for msg in msgs if msg.metadata.sequence.stream <= last_seq]
+            done = len(kept) < len(msgs) or kept[-1].metadata.sequence.stream >= last_seq
+            all_ops = compact(await parse_batch(kept, _config, pool)) if kept else {}
+            all_ops = {col: ops for col, ops in all_ops.items() if col in interaction_collections}
+            count += len(kept)
+            if first_time is None and kept:
+                # nats-py gives the time the message was stored as a naive local time
+                first_time = kept[0].metadata.timestamp.astimezone(datetime.timezone.utc)
+
+            # batches are written one after the other, the next one is fetched and parsed meanwhile
+            if pending_write is not None:
+                await pending_write
+            pending_write = asyncio.create_task(write(all_ops))
+
+            if time.monotonic() - logged > 10:
+                logged = time.monotonic()
+                logger.info(
+                    f"{count} messages, up to {kept[-1].metadata.sequence.stream if kept else '-'}/{last_seq} "
+                    f"({count / (logged - started):.0f}/s)"
+                )
+        if pending_write is not None:
+            await pending_write
+
+        if is_shutdown:
+            logger.info("Interrupted, the collections are left as they were")
+            await writer.clear()
+            return
+
+        logger.info(f"Read {count} messages in {time.monotonic() - started:.1f}s, {writer.errors} write errors")
+        # what is older than the replay is kept from the collections, with a day of margin as a record time comes
+        # from the record itself; interactions found in both are only inserted once
+        kept_before = first_time + datetime.timedelta(days=1) if first_time else None
+        await writer.finish(indexes_for, kept_before, log=logger.info)
+        if _config.INDEXER_ROLLUPS:
+            logger.info("The rollups are not rebuilt, run utilities/scripts/backfill_rollups.py")
+        logger.info(f"Rebuild done in {time.monotonic() - started:.1f}s")
+    finally:
+        try:
+            await js.delete_consumer(_config.NATS_STREAM, consumer)
+        except NotFoundError:
+            pass
+        await nats_manager.disconnect()
+        await mongo_manager.disconnect()
+        if pool is not None:
+            pool.shutdown()
+
+
+async def expire_partitions(db, router: PartitionRouter, stop_event: asyncio.Event):
+    while not stop_event.is_set():
+        for name in router.expired():
+            logger.info(f"Dropping expired partition {name}")
+            try:
+                await db.drop_collection(name)
+            except Exception as e:
+                logger.error(f"Error dropping {name}: {e}")
+        await asyncio.sleep(3600)
+
+
+async def load_post_filter(db, collections: list[str], _config: Config) -> PostFilter:
+    """Loads the snapshot and adds the posts indexed since, or every stored post without a snapshot."""
+    post_filter = PostFilter(
+        _config.INDEXER_POST_FILTER_CAPACITY, _config.INDEXER_POST_FILTER_ERROR_RATE, POST_TTL_DAYS
+    )
+    since = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(days=POST_TTL_DAYS + 1)
+    if _config.INDEXER_POST_FILTER_SNAPSHOT:
+        saved_at = post_filter.load(_config.INDEXER_POST_FILTER_SNAPSHOT)
+        if saved_at is not None:
+            # posts are added once written but indexed_at is set when parsed, hence the margin
+            since = max(since, datetime.datetime.fromtimestamp(saved_at - 600, tz=datetime.timezone.utc))
+            logger.info(f"Loaded the post filter snapshot, catching up from {since}")
+
+    started = time.monotonic()
+    count = 0
+    for collection in collections:
+        cursor = db[collection].find({"indexed_at": {"$gte": since}}, {"indexed_at": 1}, batch_size=10000)
+        async for doc in cursor:
+            post_filter.add(doc["_id"], doc["indexed_at"])
+            count += 1
+    logger.info(f"Added {count} posts to the post filter in {time.monotonic() - started:.1f}s")
+    return post_filter
+
+
+async def save_post_filter(post_filter: PostFilter, _config: Config, stop_event: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop_event.is_set():
+        await asyncio.sleep(_config.INDEXER_POST_FILTER_SNAPSHOT_INTERVAL)
+        try:
+            await loop.run_in_executor(None, post_filter.save, _config.INDEXER_POST_FILTER_SNAPSHOT, time.time())
+        except Exception as e:
+            logger.error(f"Error saving the post filter: {e}")
+
+
+async def start_uvicorn() -> None:
+    logger.info("Starting uvicorn")
+    uvicorn_config = uvicorn.config.Config(app, host="0.0.0.0", port=Config().INDEXER_PORT)
+    server = uvicorn.server.Server(uvicorn_config)
+    await server.serve()
+
+
+async def run() -> None:
+    uvicorn_task = asyncio.create_task(start_uvicorn())
+    try:
+        await main()
+    finally:
+        uvicorn_task.cancel()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(rebuild() if args.rebuild else run())
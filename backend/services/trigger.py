@@ -10,6 +10,8 @@ from atproto import (
 
 from backend.config import Config
 from backend.database import MongoDBManager
+from backend.dids import DidInterner
+from backend.partitions import partitions_between, union_pipeline
 
 config = Config()
 mongo_manager = MongoDBManager(uri=config.MONGO_URI)
@@ -56,22 +58,27 @@ async def update_top_interactions():
         if key == "post":
             agg_group["$group"]["c"] = {"$sum": "$c"}
 
-        pipeline = [
-            {
-                "$match": {
-                    "t": {
-                        "$gte": start_date,
-                    }
-                }
-            },
-            agg_group,
-            {"$sort": {"count": -1}},
-            {"$limit": 100},
-        ]
+        match = {
+            "t": {
+                "$gte": start_date,
+            }
+        }
+        collections = [collection]
+        if config.INTERACTIONS_PARTITIONED:
+            collections = partitions_between(collection, start_date, datetime.datetime.now(tz=datetime.timezone.utc))
+        pipeline = union_pipeline(
+            collections,
+            match,
+            [
+                agg_group,
+                {"$sort": {"count": -1}},
+                {"$limit": 100},
+            ],
+        )
 
         items = []
         try:
-            async for doc in db.get_collection(collection).aggregate(pipeline):
+            async for doc in db.get_collection(collections[0]).aggregate(pipeline):
                 items.append(doc)
             if items:
                 log(f"update_top_interactions: end: {key}/{subkey}")
@@ -85,6 +92,12 @@ async def update_top_interactions():
             tasks.append(_fetch(key, subkey))
 
     data = await asyncio.gather(*tasks)
+    if config.INTERACTIONS_COMPACT_DIDS:
+        dids = await DidInterner(db).resolve(x["_id"] for item in data for x in item["items"])
+        for item in data:
+            for x in item["items"]:
+                x["_id"] = dids.get(x["_id"], str(x["_id"]))
+
     did_list = []
     for item in data:
         did_list.extend([x.get("_id") for x in item["items"]])
@@ -1,41 +1,67 @@
 import asyncio
-import json
-from typing import Any, Callable, List
+import collections
+import dataclasses
+import time
+import zlib
+from typing import Any, Awaitable, Callable, List
 
 import nats
 import nats.errors
 import nats.js.errors
 import nats.js.kv
+from nats.aio.msg import Msg
 from nats.aio.subscription import Subscription
-from nats.js.api import StreamConfig
+from nats.js.client import JetStreamContext
+from nats.js.api import ConsumerConfig, StreamConfig
 
+from backend.batching import FetchPolicy, fetch_wait
+from backend.types import Event, EventBatch, EventFormat, encode_event
+
+
+def did_shard(did: str, shards: int) -> int:
+    """Shard of a repo: all the events of a DID go to the same one, so they stay in order."""
+    return zlib.crc32(did.encode()) % shards
 
-class BytesJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, bytes):
-            try:
-                return obj.decode("utf-8")  # Attempt UTF-8 decoding first
-            except UnicodeDecodeError:
-                try:
-                    return obj.decode("latin-1")  # Fallback to latin-1 if UTF-8 fails
-                except Exception:
-                    return obj.hex()  # Finally return hex if all else fails
-        return json.JSONEncoder.default(self, obj)
+
+def partition_consumer_config(config: ConsumerConfig, partition: int) -> ConsumerConfig:
+    """`config` restricted to one partition: `<name>-<partition>`, reading `<subject>.<partition>`."""
+    return dataclasses.replace(
+        config,
+        name=f"{config.name}-{partition}" if config.name else None,
+        durable_name=f"{config.durable_name}-{partition}" if config.durable_name else None,
+        filter_subjects=[f"{subject}.{partition}" for subject in config.filter_subjects or []] or None,
+        filter_subject=f"{config.filter_subject}.{partition}" if config.filter_subject else None,
+    )
 
 
 class NATSManager:
-    def __init__(self, uri: str, stream: str | None = None):
+    def __init__(
+        self,
+        uri: str,
+        stream: str | None = None,
+        max_pending: int = 4000,
+        max_retries: int = 3,
+        publish_timeout: float = 10.0,
+    ):
         self.uri = uri
         self.stream = stream
         self.nc = None
         self.js = None
         self.subscriptions: dict[str, Subscription] = {}
         self.stop_events: dict[str, asyncio.Event] = {}
+        # windowed publishing: at most max_pending acks in flight, failed publishes retried max_retries times
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        # an ack not received by then is retried, so a lost one cannot hold a pending slot forever
+        self.publish_timeout = publish_timeout
+        self._unflushed_failures = 0
+        self._pending: set[asyncio.Future] = set()
+        self._retries: set[asyncio.Task] = set()
 
     async def connect(self):
         try:
             self.nc = await nats.connect(self.uri)
-            self.js = self.nc.jetstream()
+            self.js = self.nc.jetstream(publish_async_max_pending=self.max_pending)
             print(f"Connected to NATS at {self.uri}")
         except Exception as e:
             print(f"Error connecting to NATS: {e}")
@@ -43,6 +69,10 @@ class NATSManager:
 
     async def disconnect(self):
         if self.nc and self.nc.is_connected:
+            if self._pending:
+                failed = await self.flush()
+                print(f"Flushed pending publishes before closing ({failed} failed)")
+
             for stop_event in self.stop_events.values():
                 stop_event.set()
 
@@ -83,6 +113,18 @@ class NATSManager:
                 print(f"Error creating or updating stream {self.stream}: {e}")
                 raise
 
+    async def add_partition_consumers(self, stream: str, config: ConsumerConfig, partitions: int) -> list[str]:
+        """Creates or updates one consumer per partition from `config`, returns the names of those now in place."""
+        names = []
+        for partition in range(partitions):
+            partition_config = partition_consumer_config(config, partition)
+            try:
+                await self.js.add_consumer(stream=stream, config=partition_config)
+                names.append(partition_config.durable_name or partition_config.name)
+            except Exception as e:
+                print(f"Error creating consumer {partition_config.durable_name or partition_config.name}: {e}")
+        return names
+
     async def get_or_create_kv_store(self, bucket_name: str, ttl: float | None = None) -> nats.js.kv.KeyValue:
         try:
             kv = await self.js.key_value(bucket_name)
@@ -98,50 +140,405 @@ class NATSManager:
                 print(f"Error creating key-value store {bucket_name}: {e}")
                 raise
 
-    async def pull_subscribe(self, stream: str, consumer: str, callback: Callable[[Any], None], batch_size: int = 100):
+    async def pull_subscribe(
+        self,
+        stream: str,
+        consumer: str,
+        callback: Callable[[Any], None],
+        batch_size: int | FetchPolicy = 100,
+        concurrency: int = 1,
+        on_failed: Callable[[], None] | None = None,
+    ):
+        """Calls `callback` with every batch fetched.
+
+        `concurrency` subscriptions fetch and call it in parallel, above 1 messages must be acked one by one.
+        Once `callback` raises every subscription stops and `on_failed` is called, as acking a later message could
+        ack the failed batch too.
+        """
         if self.js is None:
             raise nats.errors.NoServersError("Not connected to NATS server")
 
         try:
-            psub = await self.js.pull_subscribe_bind(consumer=consumer, stream=stream)
-            self.subscriptions[consumer] = psub
-
-            stop_event = asyncio.Event()
-            self.stop_events[consumer] = stop_event
-
-            print(f"Subscribed to JetStream with durable name: {consumer}")
+            policy = batch_size if isinstance(batch_size, FetchPolicy) else FetchPolicy(batch_size)
+            stop_events = []
 
             async def fetch_and_process(psub, stop_event):
                 while not stop_event.is_set():
-                    msgs = None
-
                     try:
-                        msgs = await psub.fetch(batch_size, timeout=1.0, heartbeat=0.2)
-                    except nats.js.errors.FetchTimeoutError as e:
-                        print(e)
-                        continue
-                    except asyncio.TimeoutError as e:
+                        msgs = await self._fetch(psub, consumer, policy.batch_size)
+                    except nats.errors.ConnectionClosedError as e:
                         print(e)
+                        break
+
+                    if not msgs:
                         continue
+
+                    try:
+                        await callback(msgs)
+                    except Exception as e:
+                        print(f"Error processing batch of {len(msgs)} messages, no more batches are processed: {e}")
+                        for worker_stop_event in stop_events:
+                            worker_stop_event.set()
+                        if on_failed:
+                            on_failed()
+                        break
+                    if len(msgs) < policy.batch_size and policy.flush_interval > 0:
+                        await asyncio.sleep(policy.flush_interval)
+
+            for worker in range(max(concurrency, 1)):
+                psub, stop_event = await self._bind(stream, consumer, f"{consumer}.{worker}" if worker else consumer)
+                stop_events.append(stop_event)
+                asyncio.create_task(fetch_and_process(psub, stop_event))
+
+        except Exception as e:
+            print(f"Error subscribing to JetStream: {e}")
+
+    async def pull_subscribe_pipelined(
+        self,
+        stream: str,
+        consumer: str,
+        prepare: Callable[[list[Msg]], Awaitable[Any]],
+        write: Callable[[list[Msg], Any], Awaitable[None]],
+        batch_size: int | FetchPolicy = 100,
+        depth: int = 2,
+        on_failed: Callable[[], None] | None = None,
+    ):
+        """Like `pull_subscribe`, but batches are fetched and prepared while earlier ones are being written.
+
+        `prepare(msgs)` starts as soon as a batch is fetched. `write(msgs, prepared)` is called with its result one
+        batch at a time in fetch order, so acking the last message of a batch is always safe. At most `depth`
+        batches are fetched and not written yet.
+
+        Once a `write` raises nothing more is written nor acked, as acking a later message would ack the failed
+        batch too: fetching stops and `on_failed` is called, the consumer redelivers the batch on restart.
+        """
+        if self.js is None:
+            raise nats.errors.NoServersError("Not connected to NATS server")
+
+        try:
+            psub, stop_event = await self._bind(stream, consumer)
+            policy = batch_size if isinstance(batch_size, FetchPolicy) else FetchPolicy(batch_size)
+            in_flight = asyncio.Semaphore(max(depth, 1))
+            batches: asyncio.Queue[tuple[list[Msg], asyncio.Task] | None] = asyncio.Queue()
+
+            async def fetch_and_prepare():
+                while not stop_event.is_set():
+                    await in_flight.acquire()
+                    try:
+                        msgs = await self._fetch(psub, consumer, policy.batch_size)
                     except nats.errors.ConnectionClosedError as e:
                         print(e)
+                        in_flight.release()
                         break
-                    except Exception as e:
-                        print(f"Error fetching messages: {e}")
 
                     if not msgs:
+                        in_flight.release()
                         continue
 
-                    await callback(msgs)
+                    await batches.put((msgs, asyncio.create_task(prepare(msgs))))
+                    if len(msgs) < policy.batch_size and policy.flush_interval > 0:
+                        await asyncio.sleep(policy.flush_interval)
+                await batches.put(None)
+
+            async def write_in_order():
+                failed = False
+                while (batch := await batches.get()) is not None:
+                    msgs, prepared = batch
+                    try:
+                        if failed:
+                            prepared.cancel()
+                        else:
+                            await write(msgs, await prepared)
+                    except Exception as e:
+                        print(f"Error processing batch of {len(msgs)} messages, no more batches are written: {e}")
+                        failed = True
+                        stop_event.set()
+                        if on_failed:
+                            on_failed()
+                    finally:
+                        in_flight.release()
 
-            asyncio.create_task(fetch_and_process(psub, stop_event))
+            asyncio.create_task(fetch_and_prepare())
+            asyncio.create_task(write_in_order())
 
         except Exception as e:
             print(f"Error subscribing to JetStream: {e}")
 
-    async def publish(self, subject: str, data: str):
+    async def _bind(
+        self, stream: str, consumer: str, key: str | None = None
+    ) -> tuple[JetStreamContext.PullSubscription, asyncio.Event]:
+        psub = await self.js.pull_subscribe_bind(consumer=consumer, stream=stream)
+        self.subscriptions[key or consumer] = psub
+
+        stop_event = asyncio.Event()
+        self.stop_events[key or consumer] = stop_event
+
+        print(f"Subscribed to JetStream with durable name: {consumer}")
+        return psub, stop_event
+
+    async def _fetch(self, psub: JetStreamContext.PullSubscription, consumer: str, batch_size: int) -> list[Msg] | None:
+        started = time.monotonic()
+        try:
+            return await psub.fetch(batch_size, timeout=1.0, heartbeat=0.2)
+        except nats.js.errors.FetchTimeoutError as e:
+            print(e)
+        except asyncio.TimeoutError as e:
+            print(e)
+        except nats.errors.ConnectionClosedError:
+            raise
+        except Exception as e:
+            print(f"Error fetching messages: {e}")
+        finally:
+            fetch_wait.labels(consumer).observe(time.monotonic() - started)
+        return None
+
+    async def publish(self, subject: str, data: bytes):
         try:
-            await self.js.publish(subject, json.dumps(data, cls=BytesJSONEncoder).encode())
+            await self.js.publish(subject, data)
             # print(f"Published message to {subject} - Stream: {ack.stream}, Sequence: {ack.seq}")
         except Exception as e:
             print(f"Error publishing to NATS subject {subject}: {e}")
+
+    async def publish_nowait(self, subject: str, data: bytes, msg_id: str | None = None) -> asyncio.Future:
+        """Publishes without waiting for the JetStream ack.
+
+        Blocks only while `max_pending` acks are in flight. The returned future resolves with the ack once the
+        message is persisted, or with the last error once all retries failed.
+
+        A retry after a lost ack can publish a message JetStream stored already: with a `msg_id` (`Nats-Msg-Id`)
+        unique to the message, the stream drops it as a duplicate within its duplicate window.
+        """
+        done = asyncio.get_running_loop().create_future()
+        self._pending.add(done)
+        done.add_done_callback(self._pending.discard)
+        headers = {"Nats-Msg-Id": msg_id} if msg_id else None
+        await self._publish_attempt(subject, data, headers, done, 0)
+        return done
+
+    async def _publish_attempt(
+        self, subject: str, payload: bytes, headers: dict | None, done: asyncio.Future, attempt: int
+    ):
+        if attempt > 0:
+            await asyncio.sleep(0.1 * 2**attempt)
+
+        try:
+            ack = await self.js.publish_async(subject, payload, headers=headers)
+        except Exception as e:
+            self._on_publish_error(subject, payload, headers, done, attempt, e)
+            return
+        ack = asyncio.ensure_future(asyncio.wait_for(ack, self.publish_timeout))
+
+        def on_ack(ack: asyncio.Future):
+            if done.done():
+                return
+            if ack.cancelled():
+                self._on_publish_error(subject, payload, headers, done, attempt, asyncio.CancelledError())
+            elif ack.exception() is not None:
+                self._on_publish_error(subject, payload, headers, done, attempt, ack.exception())
+            else:
+                done.set_result(ack.result())
+
+        ack.add_done_callback(on_ack)
+
+    def _on_publish_error(
+        self,
+        subject: str,
+        payload: bytes,
+        headers: dict | None,
+        done: asyncio.Future,
+        attempt: int,
+        e: BaseException,
+    ):
+        if attempt < self.max_retries:
+            print(f"Error publishing to NATS subject {subject} (attempt {attempt + 1}), retrying: {e!r}")
+            task = asyncio.create_task(self._publish_attempt(subject, payload, headers, done, attempt + 1))
+            self._retries.add(task)
+            task.add_done_callback(self._retries.discard)
+        else:
+            print(f"Error publishing to NATS subject {subject}, giving up: {e!r}")
+            self._unflushed_failures += 1
+            done.set_exception(e)
+
+    async def flush(self, timeout: float = 30.0) -> int:
+        """Waits for every in-flight publish, returns how many publishes were not persisted since the last flush."""
+        unfinished = set()
+        if self._pending:
+            _, unfinished = await asyncio.wait(list(self._pending), timeout=timeout)
+
+        failed = self._unflushed_failures + len(unfinished)
+        self._unflushed_failures = 0
+        return failed
+
+
+class BatchPublisher:
+    """Packs the events published to the same subject into a single `EventBatch` message.
+
+    A batch is published once it holds `max_size` events or once its first event is `max_delay` seconds old.
+    """
+
+    def __init__(self, nm: NATSManager, fmt: EventFormat, max_size: int, max_delay: float):
+        self.nm = nm
+        self.fmt = fmt
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._batches: dict[str, EventBatch] = {}
+        self._started: dict[str, float] = {}
+        self._futures: dict[str, asyncio.Future] = {}
+        self._msg_ids: dict[str, str | None] = {}
+
+    async def add(
+        self, subject: str, event: Event, seq: int | None = None, msg_id: str | None = None
+    ) -> asyncio.Future:
+        """Adds an event to the subject's batch, returns a future resolved when that batch is persisted.
+
+        The batch is published with the `msg_id` of its first event, which is in no other batch.
+        """
+        batch = self._batches.get(subject)
+        if batch is None:
+            batch = EventBatch(kind="batch", first_seq=seq, last_seq=seq, events=[])
+            self._batches[subject] = batch
+            self._started[subject] = time.monotonic()
+            self._futures[subject] = asyncio.get_running_loop().create_future()
+            self._msg_ids[subject] = msg_id
+
+        batch["events"].append(event)
+        if seq is not None:
+            batch["first_seq"] = seq if batch["first_seq"] is None else batch["first_seq"]
+            batch["last_seq"] = seq
+
+        future = self._futures[subject]
+        if len(batch["events"]) >= self.max_size:
+            await self._publish(subject)
+        return future
+
+    async def flush(self):
+        """Publishes every open batch, without waiting for the acks."""
+        for subject in list(self._batches):
+            await self._publish(subject)
+
+    async def run(self, stop_event: asyncio.Event):
+        """Publishes batches that are older than max_delay until stop_event is set."""
+        while not stop_event.is_set():
+            await asyncio.sleep(self.max_delay / 2)
+            deadline = time.monotonic() - self.max_delay
+            for subject, started in list(self._started.items()):
+                if started <= deadline:
+                    await self._publish(subject)
+        await self.flush()
+
+    async def _publish(self, subject: str):
+        batch = self._batches.pop(subject, None)
+        if batch is None:
+            return
+        del self._started[subject]
+        future = self._futures.pop(subject)
+        msg_id = self._msg_ids.pop(subject)
+
+        try:
+            ack = await self.nm.publish_nowait(subject, encode_event(batch, self.fmt), msg_id)
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        def on_ack(ack: asyncio.Future):
+            if ack.cancelled():
+                future.cancel()
+            elif ack.exception() is not None:
+                future.set_exception(ack.exception())
+            else:
+                future.set_result(ack.result())
+
+        ack.add_done_callback(on_ack)
+
+
+class Checkpointer:
+    """Saves the firehose cursor to a KV store once everything published up to it has been acked by JetStream.
+
+    Every handled frame is `track`ed with the futures of the messages it published. `run` saves the highest seq
+    whose frame and all earlier frames are fully acked, every `interval` seconds or after `max_frames` frames,
+    whichever comes first. A message that failed all its retries is reported once through `on_failed` and the
+    cursor never moves past its frame: the service is expected to stop and read the firehose again from the cursor.
+    """
+
+    def __init__(
+        self,
+        kv: nats.js.kv.KeyValue,
+        key: str,
+        interval: float,
+        max_frames: int,
+        on_save: Callable[[int], None] | None = None,
+        on_failed: Callable[[int], None] | None = None,
+    ):
+        self.kv = kv
+        self.key = key
+        self.interval = interval
+        self.max_frames = max_frames
+        self.on_save = on_save
+        self.on_failed = on_failed
+        self.saved: int | None = None
+        self.failed = False
+        self._acked: int | None = None
+        self._pending: collections.deque[tuple[int, list[asyncio.Future]]] = collections.deque()
+        self._frames = 0
+        self._due = asyncio.Event()
+
+    def track(self, seq: int, futures: list[asyncio.Future]):
+        futures = [future for future in futures if not future.done() or _publish_failed(future)]
+        if not futures and not self._pending:
+            self._acked = seq
+        else:
+            self._pending.append((seq, futures))
+
+        self._frames += 1
+        if self._frames >= self.max_frames:
+            self._due.set()
+
+    async def save(self):
+        """Saves the acked seq if it moved since the last save."""
+        self._frames = 0
+        self._advance()
+        if self._acked is None or self._acked == self.saved:
+            return
+
+        seq = self._acked
+        try:
+            await self.kv.put(self.key, str(seq).encode())
+        except Exception as e:
+            print(f"Error saving cursor {seq}: {e}")
+            return
+
+        self.saved = seq
+        if self.on_save:
+            self.on_save(seq)
+
+    async def run(self, stop_event: asyncio.Event):
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(self._due.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._due.clear()
+            await self.save()
+
+    def _advance(self):
+        while self._pending:
+            seq, futures = self._pending[0]
+            if not all(future.done() for future in futures):
+                return
+
+            failed = sum(1 for future in futures if _publish_failed(future))
+            if failed:
+                # the frame stays pending, the cursor is held at the last frame JetStream stored entirely
+                if not self.failed:
+                    self.failed = True
+                    print(f"{failed} messages of seq {seq} were not persisted, holding the cursor at {self._acked}")
+                    if self.on_failed:
+                        self.on_failed(failed)
+                return
+            self._pending.popleft()
+            self._acked = seq
+
+
+def _publish_failed(future: asyncio.Future) -> bool:
+    # retrieving the exception also keeps asyncio from warning about it
+    return future.done() and (future.cancelled() or future.exception() is not None)
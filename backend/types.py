@@ -1,5 +1,8 @@
+import json
 from typing import Literal, TypedDict, Union
 
+import libipld
+
 
 # Firehose
 class CommitCreate(TypedDict):
@@ -46,6 +49,58 @@ class EventCommit(TypedDict):
 Event = Union[EventAccount, EventIdentity, EventCommit]
 
 
+class EventBatch(TypedDict):
+    kind: Literal["batch"]
+    first_seq: int | None
+    last_seq: int | None
+    events: list[Event]
+
+
+# NATS payloads
+EventFormat = Literal["json", "cbor"]
+
+# cbor envelope: magic + version byte + DAG-CBOR encoded event
+ENVELOPE_MAGIC = b"bsk"
+ENVELOPE_VERSION = 1
+
+
+class BytesJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, bytes):
+            try:
+                return obj.decode("utf-8")  # Attempt UTF-8 decoding first
+            except UnicodeDecodeError:
+                try:
+                    return obj.decode("latin-1")  # Fallback to latin-1 if UTF-8 fails
+                except Exception:
+                    return obj.hex()  # Finally return hex if all else fails
+        return json.JSONEncoder.default(self, obj)
+
+
+def encode_event(event: Event | EventBatch, fmt: EventFormat = "json") -> bytes:
+    if fmt == "cbor":
+        return ENVELOPE_MAGIC + bytes([ENVELOPE_VERSION]) + libipld.encode_dag_cbor(event)
+    return json.dumps(event, cls=BytesJSONEncoder).encode()
+
+
+def decode_event(data: bytes, fmt: EventFormat = "json") -> Event | EventBatch:
+    if fmt == "cbor":
+        if data[: len(ENVELOPE_MAGIC)] != ENVELOPE_MAGIC:
+            raise ValueError("not a cbor event envelope")
+        version = data[len(ENVELOPE_MAGIC)]
+        if version != ENVELOPE_VERSION:
+            raise ValueError(f"unsupported event envelope version: {version}")
+        return libipld.decode_dag_cbor(data[len(ENVELOPE_MAGIC) + 1 :])
+    return json.loads(data)
+
+
+class DecodedFrame(TypedDict):
+    seq: int | None
+    events: list[Event]
+    car_bytes: int
+    car_skipped_bytes: int
+
+
 # interactions
 class Interaction(TypedDict):
     _id: str
@@ -0,0 +1,100 @@
+import asyncio
+import random
+
+from backend.buffers import BufferedWriter, BufferPolicy
+
+
+class Recorder:
+    """Write and ack callbacks keeping what they were called with."""
+
+    def __init__(self, fail_on: set[str] = frozenset()):
+        self.fail_on = fail_on
+        self.written = []
+        self.acked = []
+        self.naked = []
+
+    async def write(self, target: str, ops: list):
+        # writes finish in a random order
+        await asyncio.sleep(random.random() / 100)
+        if self.fail_on & set(ops):
+            raise RuntimeError("write failed")
+        self.written.append((target, ops))
+
+    async def ack(self, msgs: list):
+        self.acked.extend(msgs)
+
+    async def nak(self, msgs: list):
+        self.naked.extend(msgs)
+
+
+def test_batches_are_acked_in_order_once_written():
+    async def run():
+        recorder = Recorder()
+        writer = BufferedWriter(
+            recorder.write,
+            recorder.ack,
+            BufferPolicy(max_ops=3, max_age=60, concurrency=4),
+            {"slow": BufferPolicy(max_ops=1000, max_age=60)},
+            max_batches=100,
+        )
+        for batch in range(50):
+            ops = {"fast": [f"f{batch}"]}
+            if batch % 7 == 0:
+                ops["slow"] = [f"s{batch}"]
+            await writer.add([batch], ops)
+            await asyncio.sleep(0)
+        # the first batch has an op in the slow buffer, never flushed yet
+        assert recorder.acked == []
+
+        await writer.close()
+        assert recorder.acked == list(range(50))
+
+    asyncio.run(run())
+
+
+def test_full_window_flushes_the_buffers_holding_the_oldest_batch():
+    async def run():
+        recorder = Recorder()
+        writer = BufferedWriter(recorder.write, recorder.ack, BufferPolicy(max_ops=1000, max_age=60), max_batches=4)
+        for batch in range(10):
+            await asyncio.wait_for(writer.add([batch], {"col": [batch]}), timeout=1)
+        assert recorder.acked == list(range(len(recorder.acked)))
+        assert len(recorder.acked) >= 6
+        await writer.close()
+        assert recorder.acked == list(range(10))
+
+    asyncio.run(run())
+
+
+def test_failed_write_stops_acking():
+    async def run():
+        recorder = Recorder(fail_on={"bad"})
+        writer = BufferedWriter(recorder.write, recorder.ack, BufferPolicy(max_ops=1, max_age=60))
+        await writer.add([0], {"col": ["ok"]})
+        await writer.add([1], {"col": ["bad"]})
+        await writer.add([2], {"col": ["ok2"]})
+        await writer.close()
+        # acking 2 would ack 1 as well
+        assert recorder.acked == [0]
+        assert writer.failed
+
+        await writer.add([3], {"col": ["ok3"]})
+        await writer.close()
+        assert recorder.acked == [0]
+
+    asyncio.run(run())
+
+
+def test_failed_write_is_naked_with_explicit_acks():
+    async def run():
+        recorder = Recorder(fail_on={"bad"})
+        writer = BufferedWriter(recorder.write, recorder.ack, BufferPolicy(max_ops=1, max_age=60), nak=recorder.nak)
+        await writer.add([0], {"col": ["ok"]})
+        await writer.add([1], {"col": ["bad"], "other": ["ok1"]})
+        await writer.add([2], {"col": ["ok2"]})
+        await writer.close()
+        assert sorted(recorder.acked) == [0, 2]
+        assert recorder.naked == [1]
+        assert not writer.failed
+
+    asyncio.run(run())
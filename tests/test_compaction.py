@@ -0,0 +1,69 @@
+from backend.compaction import (
+    cancel_created_deleted,
+    coalesce_tallies,
+    compact,
+    merge_profile_updates,
+    split_by_document,
+)
+from backend.indexing import CreateDoc, DeleteDoc, ProfileUpdate, TallyInc
+
+
+def test_create_then_delete_drops_the_create_keeps_the_delete():
+    ops = [CreateDoc({"_id": "did:a/1"}), CreateDoc({"_id": "did:a/2"}), DeleteDoc("did:a/1")]
+    compacted = cancel_created_deleted(ops)
+    assert [(type(op), op.key) for op in compacted] == [(CreateDoc, "did:a/2"), (DeleteDoc, "did:a/1")]
+
+
+def test_delete_then_create_is_left_as_it_is():
+    ops = [DeleteDoc("did:a/1"), CreateDoc({"_id": "did:a/1"})]
+    assert cancel_created_deleted(ops) == ops
+
+
+def test_create_after_a_delete_is_kept():
+    ops = [CreateDoc({"_id": "did:a/1"}), DeleteDoc("did:a/1"), CreateDoc({"_id": "did:a/1"})]
+    compacted = cancel_created_deleted(ops)
+    assert [type(op) for op in compacted] == [DeleteDoc, CreateDoc]
+
+
+def test_profile_updates_merge_in_place_of_the_first_later_values_win():
+    other = DeleteDoc("x")
+    ops = [
+        ProfileUpdate("did:a", {"handle": "a", "active": True}, {"indexed_at": 1}),
+        other,
+        ProfileUpdate("did:b", {"handle": "b"}),
+        ProfileUpdate("did:a", {"handle": "a2"}, {"indexed_at": 2}),
+    ]
+    compacted = merge_profile_updates(ops)
+    assert len(compacted) == 3
+    assert compacted[1] is other
+    merged = compacted[0]
+    assert merged.did == "did:a"
+    assert merged.set_fields == {"handle": "a2", "active": True}
+    # only the first update can insert the profile
+    assert merged.set_on_insert == {"indexed_at": 1}
+    assert compacted[2].did == "did:b"
+
+
+def test_tallies_of_a_post_are_summed():
+    ops = [TallyInc("p1", {"tally.likes": 1}), TallyInc("p2", {"tally.likes": 1}), TallyInc("p1", {"tally.likes": 1})]
+    compacted = coalesce_tallies(ops)
+    assert [(op.target, op.fields) for op in compacted] == [("p1", {"tally.likes": 2}), ("p2", {"tally.likes": 1})]
+
+
+def test_compact_applies_every_step_per_collection():
+    all_ops = {
+        "interactions.like": [CreateDoc({"_id": "did:a/1"}), DeleteDoc("did:a/1")],
+        "app.bsky.actor.profile": [ProfileUpdate("did:a", {"x": 1}), ProfileUpdate("did:a", {"y": 2})],
+    }
+    compacted = compact(all_ops)
+    assert [type(op) for op in compacted["interactions.like"]] == [DeleteDoc]
+    assert [op.set_fields for op in compacted["app.bsky.actor.profile"]] == [{"x": 1, "y": 2}]
+
+
+def test_split_keeps_the_ops_of_a_document_together_in_order():
+    ops = [ProfileUpdate(f"did:{i % 5}", {"n": i}) for i in range(50)]
+    groups = split_by_document(ops, 4)
+    assert sorted(op.set_fields["n"] for group in groups for op in group) == list(range(50))
+    for did in {op.did for op in ops}:
+        holding = [[op.set_fields["n"] for op in group if op.did == did] for group in groups]
+        assert [n for n in holding if n] == [list(range(int(did[-1]), 50, 5))]
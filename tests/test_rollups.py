@@ -0,0 +1,23 @@
+import datetime
+
+from backend.indexing import _get_date
+from backend.rollups import rollup_incs, rollup_key
+
+
+def test_rollup_key_is_the_utc_hour():
+    local = datetime.datetime(2025, 2, 10, 10, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=5)))
+    naive_utc = datetime.datetime(2025, 2, 10, 5)
+    assert rollup_key("did:a", "did:b", local) == "did:a/did:b/2025021005"
+    assert rollup_key("did:a", "did:b", naive_utc) == "did:a/did:b/2025021005"
+
+
+def test_record_time_with_an_offset_is_truncated_in_utc():
+    assert _get_date("2025-02-10T10:30:00+05:30") == datetime.datetime(2025, 2, 10, 5, tzinfo=datetime.timezone.utc)
+    assert _get_date("2025-02-10T10:30:00.000Z") == datetime.datetime(2025, 2, 10, 10, tzinfo=datetime.timezone.utc)
+
+
+def test_create_and_delete_with_an_offset_cancel_out():
+    created = {"a": "did:a", "s": "did:b", "t": _get_date("2025-02-10T10:30:00+05:00"), "c": 0}
+    # read back from mongo: naive UTC
+    deleted = {**created, "t": datetime.datetime(2025, 2, 10, 5)}
+    assert rollup_incs("l", [created], [deleted]) == []
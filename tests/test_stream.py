@@ -0,0 +1,85 @@
+import asyncio
+
+from backend.stream import Checkpointer
+
+
+class FakeKV:
+    def __init__(self):
+        self.values = {}
+
+    async def put(self, key: str, value: bytes):
+        self.values[key] = value
+
+
+def checkpointer(**kwargs) -> tuple[Checkpointer, FakeKV]:
+    kv = FakeKV()
+    return Checkpointer(kv, "cursor", interval=1, max_frames=1000, **kwargs), kv
+
+
+def test_cursor_waits_for_every_earlier_frame():
+    async def run():
+        loop = asyncio.get_running_loop()
+        cp, kv = checkpointer()
+        first, second = loop.create_future(), loop.create_future()
+        cp.track(1, [first])
+        cp.track(2, [second])
+        second.set_result(None)
+        await cp.save()
+        assert cp.saved is None and kv.values == {}
+
+        first.set_result(None)
+        await cp.save()
+        assert cp.saved == 2 and kv.values == {"cursor": b"2"}
+
+    asyncio.run(run())
+
+
+def test_frames_without_publishes_move_the_cursor():
+    async def run():
+        cp, kv = checkpointer()
+        cp.track(1, [])
+        cp.track(2, [])
+        await cp.save()
+        assert kv.values == {"cursor": b"2"}
+
+    asyncio.run(run())
+
+
+def test_cursor_never_passes_a_failed_publish():
+    async def run():
+        loop = asyncio.get_running_loop()
+        failures = []
+        cp, kv = checkpointer(on_failed=failures.append)
+        acked, failed, pending, later = (loop.create_future() for _ in range(4))
+        cp.track(1, [acked])
+        cp.track(2, [failed, pending])
+        cp.track(3, [later])
+        acked.set_result(None)
+        failed.set_exception(RuntimeError("not persisted"))
+        later.set_result(None)
+        await cp.save()
+        assert cp.saved == 1 and not cp.failed
+
+        # once every publish of the frame is done, the failure is reported and the frame stays pending
+        pending.set_result(None)
+        await cp.save()
+        await cp.save()
+        assert cp.saved == 1 and cp.failed
+        assert kv.values == {"cursor": b"1"}
+        assert failures == [1]
+
+    asyncio.run(run())
+
+
+def test_frame_tracked_with_an_already_failed_publish_holds_the_cursor():
+    async def run():
+        loop = asyncio.get_running_loop()
+        cp, _ = checkpointer()
+        failed = loop.create_future()
+        failed.cancel()
+        cp.track(1, [failed])
+        cp.track(2, [])
+        await cp.save()
+        assert cp.saved is None and cp.failed
+
+    asyncio.run(run())
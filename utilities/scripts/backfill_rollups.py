@@ -0,0 +1,53 @@
+# builds the hourly interaction rollups from the raw interaction collections
+#
+#   INDEXER_ROLLUPS=true python -m backend.services.indexer   # the indexer counts everything from now on
+#   python -m utilities.scripts.backfill_rollups               # once the next hour has started
+#   INTERACTIONS_FROM_ROLLUPS=true                             # then FART can read the rollups
+#
+# every rollup before --until is recomputed from the raw documents, rerunning it is harmless
+import argparse
+import asyncio
+import datetime
+import time
+
+from backend.config import Config
+from backend.database import MongoDBManager
+from backend.defaults import INTERACTION_RECORDS
+from backend.partitions import partition_day
+from backend.rollups import ROLLUP_INDEXES, backfill_pipeline, rollup_collection
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--since", type=datetime.datetime.fromisoformat, help="first hour to rebuild, default all")
+parser.add_argument(
+    "--until", type=datetime.datetime.fromisoformat, help="hour to stop at (excluded), default the current one"
+)
+args = parser.parse_args()
+
+
+async def main():
+    config = Config()
+    mongo_manager = MongoDBManager(uri=config.MONGO_URI)
+    await mongo_manager.connect()
+    db = mongo_manager.client.get_database(config.INDEXER_DB)
+
+    until = args.until or datetime.datetime.now(tz=datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    await db[rollup_collection(config.INTERACTIONS_COLLECTION)].create_indexes(ROLLUP_INDEXES)
+
+    names = await db.list_collection_names()
+    for record_type in INTERACTION_RECORDS:
+        collection = "{}.{}".format(config.INTERACTIONS_COLLECTION, record_type.split(".")[-1])
+        # an hour can span two partitions, they are all read at once
+        collections = [collection] + sorted(name for name in names if partition_day(collection, name))
+        print(f"{collection}: rolling up {args.since or 'everything'} to {until} from {len(collections)} collections")
+        started = time.monotonic()
+        pipeline = backfill_pipeline(record_type, config.INTERACTIONS_COLLECTION, args.since, until, collections)
+        # $merge writes server side, the cursor returns nothing
+        async for _ in db[collection].aggregate(pipeline, allowDiskUse=True):
+            pass
+        print(f"{collection}: done in {time.monotonic() - started:.1f}s")
+
+    await mongo_manager.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+# converts the interaction collections, their partitions and the hourly rollups to compact DIDs
+#
+#   stop the indexer (messages wait in nats-js), then
+#   python -m utilities.scripts.migrate_compact_dids
+#   INTERACTIONS_COMPACT_DIDS=true for the indexer, FART and trigger
+#
+# every collection is copied to `<name>.migrating` with the same indexes, then renamed over the original. Documents
+# that are compact already are copied as they are, so an interrupted migration can be run again
+import argparse
+import asyncio
+import time
+
+from pymongo import IndexModel
+
+from backend.config import Config
+from backend.database import MongoDBManager
+from backend.defaults import INTERACTION_RECORDS
+from backend.dids import DidInterner, compact_interaction
+from backend.partitions import partition_day
+from backend.rollups import rollup_collection, rollup_key
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch-size", type=int, default=10000)
+args = parser.parse_args()
+
+
+async def compact_interactions(interner: DidInterner, docs: list[dict]) -> list[dict]:
+    numbers = await interner.intern(did for doc in docs if isinstance(doc["a"], str) for did in (doc["a"], doc["s"]))
+    return [compact_interaction(doc, numbers) if isinstance(doc["a"], str) else doc for doc in docs]
+
+
+async def compact_rollups(interner: DidInterner, docs: list[dict]) -> list[dict]:
+    numbers = await interner.intern(did for doc in docs if isinstance(doc["a"], str) for did in (doc["a"], doc["s"]))
+    compacted = []
+    for doc in docs:
+        if isinstance(doc["a"], str):
+            author, subject = numbers[doc["a"]], numbers[doc["s"]]
+            doc = {**doc, "_id": rollup_key(author, subject, doc["t"]), "a": author, "s": subject}
+        compacted.append(doc)
+    return compacted
+
+
+async def migrate(mongo_manager: MongoDBManager, db, name: str, compact):
+    tmp = f"{name}.migrating"
+    await db.drop_collection(tmp)
+
+    started = time.monotonic()
+    count = 0
+    batch = []
+    async for doc in db[name].find({}, batch_size=args.batch_size):
+        batch.append(doc)
+        if len(batch) >= args.batch_size:
+            await db[tmp].insert_many(await compact(batch), ordered=False)
+            count += len(batch)
+            batch = []
+    if batch:
+        await db[tmp].insert_many(await compact(batch), ordered=False)
+        count += len(batch)
+
+    # indexes are built once the documents are in
+    indexes = []
+    for index_name, spec in (await db[name].index_information()).items():
+        if index_name == "_id_":
+            continue
+        options = {key: spec[key] for key in ("expireAfterSeconds", "unique", "partialFilterExpression") if key in spec}
+        indexes.append(IndexModel(spec["key"], name=index_name, **options))
+    if indexes:
+        await db[tmp].create_indexes(indexes)
+
+    if count:
+        await mongo_manager.client.admin.command(
+            "renameCollection", f"{db.name}.{tmp}", to=f"{db.name}.{name}", dropTarget=True
+        )
+    else:
+        await db.drop_collection(tmp)
+    print(f"{name}: {count} documents in {time.monotonic() - started:.1f}s")
+
+
+async def main():
+    config = Config()
+    mongo_manager = MongoDBManager(uri=config.MONGO_URI)
+    await mongo_manager.connect()
+    db = mongo_manager.client.get_database(config.INDEXER_DB)
+    interner = DidInterner(db, config.DIDS_CACHE_SIZE)
+    await interner.create_indexes()
+
+    names = await db.list_collection_names()
+    for record_type in INTERACTION_RECORDS:
+        collection = "{}.{}".format(config.INTERACTIONS_COLLECTION, record_type.split(".")[-1])
+        for name in [collection] + sorted(name for name in names if partition_day(collection, name)):
+            if name in names:
+                await migrate(mongo_manager, db, name, lambda docs: compact_interactions(interner, docs))
+
+    if rollup_collection(config.INTERACTIONS_COLLECTION) in names:
+        await migrate(
+            mongo_manager,
+            db,
+            rollup_collection(config.INTERACTIONS_COLLECTION),
+            lambda docs: compact_rollups(interner, docs),
+        )
+
+    await mongo_manager.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
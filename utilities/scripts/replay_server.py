@@ -0,0 +1,48 @@
+# local websocket stand-in for the relay or jetstream: serves frames captured with `enjoyer --capture`
+#
+#   python -m utilities.scripts.replay_server /path/to/capture --port 6008
+#   ENJOYER_SOURCE=jetstream ENJOYER_JETSTREAM_URI=ws://localhost:6008/subscribe python -m backend.services.enjoyer
+#
+# query parameters (cursor, wantedCollections, ...) are ignored: every connection gets the whole capture
+import argparse
+import asyncio
+import time
+
+import websockets
+
+from backend.segments import list_segments, read_segment
+
+parser = argparse.ArgumentParser()
+parser.add_argument("path", help="capture segment or directory of segments")
+parser.add_argument("--host", default="localhost")
+parser.add_argument("--port", type=int, default=6008)
+parser.add_argument("--speed", type=float, default=0, help="multiple of real time, 0 is as fast as possible")
+args = parser.parse_args()
+
+
+async def serve_frames(websocket):
+    print("client connected")
+    started = time.monotonic()
+    first_received_at = None
+    sent = 0
+    for segment in list_segments(args.path):
+        for received_at, frame in read_segment(segment):
+            if args.speed > 0:
+                first_received_at = first_received_at or received_at
+                delay = (received_at - first_received_at) / args.speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await websocket.send(frame)
+            sent += 1
+    print(f"sent {sent} frames in {time.monotonic() - started:.1f}s")
+    await websocket.wait_closed()
+
+
+async def main():
+    async with websockets.serve(serve_frames, args.host, args.port, max_size=None):
+        print(f"serving {args.path} on ws://{args.host}:{args.port}")
+        await asyncio.Future()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())